@@ -1,4 +1,6 @@
+import sys
+
 import main
 
 if __name__ == "__main__":
-    main.main()
+    sys.exit(main.main())
@@ -0,0 +1,276 @@
+"""Times git-all's hot paths against synthetic fixtures.
+
+Builds a throwaway configuration directory, thousands of fake checkouts and a
+local stub of the bitbucket API, runs each stage and prints per-stage timings,
+throughput and peak memory as JSON:
+
+    python src/benchmark.py --repos 2000 --output bench.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TEAM = 'bench-team'
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCAL_COMMANDS = ['users', 'groups', 'repos']
+# Seconds a local-only command may add on top of starting a bare interpreter
+DEFAULT_STARTUP_BUDGET = 0.1
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_fixture(repos, projects):
+    fixture = {TEAM: {}}
+    for index in range(repos):
+        project = 'P{:03d}'.format(index % projects)
+        fixture[TEAM].setdefault(project, []).append('repo-{:05d}'.format(index))
+    return fixture
+
+
+def make_checkouts(root, fixture):
+    """Lay out minimal .git directories: enough for git-all to recognise a
+    checkout without paying for thousands of `git init` runs."""
+    for project_repos in fixture[TEAM].values():
+        for repo in project_repos:
+            git_dir = os.path.join(root, repo, '.git')
+            os.makedirs(os.path.join(git_dir, 'refs', 'heads'))
+            os.makedirs(os.path.join(git_dir, 'objects'))
+            with open(os.path.join(git_dir, 'HEAD'), 'w') as head_file:
+                head_file.write('ref: refs/heads/master\n')
+            with open(os.path.join(git_dir, 'config'), 'w') as config_file:
+                config_file.write(
+                    '[core]\n\trepositoryformatversion = 0\n'
+                    '[remote "origin"]\n\turl = git@bitbucket.org:{}/{}.git\n'
+                    '\tfetch = +refs/heads/*:refs/remotes/origin/*\n'.format(TEAM, repo)
+                )
+
+
+def median_runtime(command, runs, env):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def measure_startup(runs):
+    """Time local-only commands in fresh interpreters, relative to a bare
+    interpreter, and check that none of them import the network stack."""
+    env = dict(os.environ)
+    baseline = median_runtime([sys.executable, '-c', 'pass'], runs, env)
+    report = {'python_seconds': round(baseline, 6), 'commands': []}
+
+    for command in LOCAL_COMMANDS:
+        seconds = median_runtime(
+            [sys.executable, os.path.join(SRC_DIR, '__main__.py'), command],
+            runs, env
+        )
+        imports_network = subprocess.run(
+            [sys.executable, '-c',
+             'import sys; sys.argv = ["git-all", {!r}]; import main; main.main(); '
+             'sys.exit("requests" in sys.modules)'.format(command)],
+            cwd=SRC_DIR, env=env, stdout=subprocess.DEVNULL
+        ).returncode != 0
+        report['commands'].append({
+            'command': command,
+            'seconds': round(seconds, 6),
+            'overhead_seconds': round(seconds - baseline, 6),
+            'imports_network_stack': imports_network
+        })
+    return report
+
+
+def check_startup(startup, budget):
+    failures = []
+    for command in startup['commands']:
+        if command['overhead_seconds'] > budget:
+            failures.append('{} took {:.3f}s over a bare interpreter (budget {:.3f}s)'.format(
+                command['command'], command['overhead_seconds'], budget
+            ))
+        if command['imports_network_stack']:
+            failures.append('{} imported requests'.format(command['command']))
+    return failures
+
+
+class Benchmark:
+    def __init__(self):
+        self.stages = []
+
+    def stage(self, name, func, items=None):
+        # Keep progress chatter from the code under test out of the report
+        with contextlib.redirect_stdout(sys.stderr):
+            start = time.perf_counter()
+            result = func()
+            seconds = time.perf_counter() - start
+        record = {
+            'stage': name,
+            'seconds': round(seconds, 6),
+            'peak_rss_kb': peak_rss_kb()
+        }
+        if items:
+            record['items'] = items
+            record['items_per_sec'] = round(items / seconds, 1) if seconds else None
+        self.stages.append(record)
+        sys.stderr.write('{:<28} {:>10.4f}s\n'.format(name, seconds))
+        return result
+
+
+def run(args, work_dir):
+    conf_dir = os.path.join(work_dir, 'conf')
+    checkouts = os.path.join(work_dir, 'checkouts')
+    os.makedirs(conf_dir)
+    os.makedirs(checkouts)
+    os.environ['GIT_ALL_CONF_DIR'] = conf_dir
+
+    import bitbucket_client
+    import bitbucket_stub
+    import state
+    from controller import Controller
+    from main import Commands
+
+    fixture = make_fixture(args.repos, args.projects)
+    all_repos = [
+        '{}/{}'.format(TEAM, repo)
+        for project in sorted(fixture[TEAM])
+        for repo in fixture[TEAM][project]
+    ]
+    n = len(all_repos)
+    bench = Benchmark()
+
+    bench.stage('make_checkouts', lambda: make_checkouts(checkouts, fixture), n)
+
+    server = bitbucket_stub.serve(fixture, delay=args.latency)
+    bitbucket_client.API_URL = server.api_url
+
+    def populate_json_state():
+        json_state = state.State(state.conf_path('credentials.conf'))
+        json_state.update_user_credentials('bench', 'YmVuY2g6YmVuY2g=')
+        json_state.set_default_user('bench')
+        json_state.add_to_repository_group('all', all_repos)
+        json_state.add_to_repository_group('half', all_repos[::2])
+        for repo in all_repos:
+            json_state.set_repo_path(repo, checkouts)
+            json_state.add_repo_location(checkouts, repo)
+        json_state.commit()
+
+    bench.stage('json_state_save', populate_json_state, n)
+    bench.stage('json_state_load',
+                lambda: state.State(state.conf_path('credentials.conf')), n)
+    bench.stage('sqlite_state_migrate', lambda: state.get_state().close(), n)
+
+    with Controller() as controller:
+        commands = Commands(controller)
+        bench.stage('state_get_repo_paths',
+                    lambda: controller.get_repo_paths(all_repos), n)
+        bench.stage('state_get_repo_paths_at',
+                    lambda: controller.get_repo_paths(all_repos, checkouts), n)
+        bench.stage('parse_repos_groups',
+                    lambda: commands.parse_repos('/all,-/half'), n)
+
+        controller.discovery_cache.refresh = True
+        requests_before = server.request_count
+        bench.stage('discovery_uncached',
+                    lambda: list(controller.get_repos_for_team('bench', TEAM)), n)
+        api_requests = server.request_count - requests_before
+        controller.discovery_cache.refresh = False
+        bench.stage('discovery_cached',
+                    lambda: list(controller.get_repos_for_team('bench', TEAM)), n)
+
+        bench.stage('check_for_repo_cold',
+                    lambda: controller.find_checkouts(all_repos, checkouts), n)
+        bench.stage('check_for_repo_warm',
+                    lambda: controller.find_checkouts(all_repos, checkouts), n)
+
+        run_repos = ','.join(all_repos[:args.run_repos])
+        bench.stage(
+            'run_in_repos',
+            lambda: commands.run_in_repos(run_repos, ['true'], quiet=True,
+                                          clean=False, stream=False, log_dir=None,
+                                          output_format='text', jobs=args.jobs,
+                                          timeout=None, location=None,
+                                          script=None, max_load=None,
+                                          nice=None, workers=None,
+                                          changed_since=None, branch=None,
+                                          dirty=False),
+            min(n, args.run_repos)
+        )
+
+        def narrow_all():
+            # Matches no checkout, so this is the cost of the filter alone
+            return commands.run_in_repos(','.join(all_repos), ['true'],
+                                         quiet=True, clean=False, stream=False,
+                                         log_dir=None, output_format='text',
+                                         jobs=args.jobs, timeout=None,
+                                         location=None, script=None,
+                                         max_load=None, nice=None, workers=None,
+                                         changed_since=None,
+                                         branch='no-such-branch', dirty=False)
+
+        bench.stage('do_filter_cold', narrow_all, n)
+        bench.stage('do_filter_warm', narrow_all, n)
+    server.shutdown()
+
+    startup = bench.stage('startup', lambda: measure_startup(args.startup_runs))
+
+    return {
+        'repos': n,
+        'projects': args.projects,
+        'api_latency': args.latency,
+        'api_requests': api_requests,
+        'peak_rss_kb': peak_rss_kb(),
+        'stages': bench.stages,
+        'startup': startup
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark git-all hot paths.')
+    parser.add_argument('--repos', type=int, default=2000)
+    parser.add_argument('--projects', type=int, default=40)
+    parser.add_argument('--run-repos', type=int, default=200,
+                        help='How many repos to spawn a command in')
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of simulated bitbucket latency')
+    parser.add_argument('--startup-runs', type=int, default=5)
+    parser.add_argument('--startup-budget', type=float,
+                        default=DEFAULT_STARTUP_BUDGET,
+                        help='Fail if a local command adds more than this many '
+                             'seconds of startup over a bare interpreter')
+    parser.add_argument('--output', help='Write the JSON report here')
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't delete the fixture directory")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='git-all-bench-')
+    try:
+        report = run(args, work_dir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+    failures = check_startup(report['startup'], args.startup_budget)
+    for failure in failures:
+        sys.stderr.write('Startup regression: {}\n'.format(failure))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
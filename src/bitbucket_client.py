@@ -1,5 +1,172 @@
-import json
-import requests
+import itertools
+import math
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+import metrics
+from executor import ordered_map
+
+# requests (and urllib3, charset detection, certifi...) takes longer to import
+# than most local commands take to run, so it's only loaded once a command
+# actually talks to bitbucket
+
+API_URL = os.environ.get('GIT_ALL_BITBUCKET_API', 'https://api.bitbucket.org/2.0')
+MAX_CONNECTIONS = 16
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 5
+MAX_BACKOFF = 60
+RATE_LIMIT = float(os.environ.get('GIT_ALL_BITBUCKET_RATE', 20))
+RATE_BURST = int(os.environ.get('GIT_ALL_BITBUCKET_BURST', 60))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Ask for the largest pages bitbucket allows, and only the fields git-all reads
+PAGELEN = 100
+PROJECT_FIELDS = 'values.key,next,size,pagelen'
+REPOSITORY_FIELDS = 'values.full_name,next,size,pagelen'
+REPOSITORY_FILTER = re.compile(r'^(?P<field>name|language|since)(?P<operator>~|=)(?P<value>.+)$')
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class BitbucketError(IOError):
+    pass
+
+
+def session():
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            import requests
+            import requests.adapters
+
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                    pool_maxsize=MAX_CONNECTIONS)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+    return _session
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, and take it. Returns how long
+        the caller had to wait."""
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def retry_after(resp):
+    value = resp.headers.get('Retry-After') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Scheduler:
+    """Sends every bitbucket request: at most RATE_LIMIT a second (in bursts
+    of RATE_BURST), at most MAX_CONNECTIONS at once, each with a timeout, and
+    retrying throttled, failed and 5xx requests with jittered exponential
+    backoff that honors Retry-After."""
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST,
+                 concurrency=MAX_CONNECTIONS, retries=MAX_RETRIES,
+                 timeout=REQUEST_TIMEOUT):
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.retries = retries
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.counters = {
+            'requests': 0,
+            'retries': 0,
+            'throttled': 0,
+            'rate_limited_seconds': 0.0
+        }
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def get(self, url, headers):
+        import requests
+
+        for attempt in range(self.retries + 1):
+            self.count('rate_limited_seconds', self.bucket.acquire())
+            resp, error = None, None
+            with self.slots:
+                self.count('requests')
+                try:
+                    resp = session().get(url, headers=headers, timeout=self.timeout)
+                except requests.RequestException as e:
+                    error = e
+
+            if resp is not None and resp.status_code not in RETRY_STATUSES:
+                return resp
+            if resp is not None:
+                error = '{} {}'.format(resp.status_code, resp.reason)
+                if resp.status_code == 429:
+                    self.count('throttled')
+            if attempt == self.retries:
+                break
+
+            delay = retry_after(resp)
+            if delay is None:
+                import random
+
+                delay = random.uniform(0, min(MAX_BACKOFF, 0.5 * 2 ** attempt))
+            self.count('retries')
+            time.sleep(min(delay, MAX_BACKOFF))
+
+        raise BitbucketError('GET {} failed after {} attempts: {}'.format(
+            url, self.retries + 1, error
+        ))
+
+
+scheduler = Scheduler()
+
+
+def fetch_json(url, headers, validators=None):
+    resp = scheduler.get(url, headers)
+    if resp.status_code >= 400:
+        raise BitbucketError('GET {}: {} {}'.format(url, resp.status_code, resp.reason))
+    if validators is not None:
+        record_validators(resp, validators)
+    try:
+        return resp.json()
+    except ValueError:
+        raise BitbucketError('GET {}: response was not JSON'.format(url))
 
 
 def headers(auth_phrase):
@@ -8,59 +175,132 @@ def headers(auth_phrase):
     }
 
 
-def get_teams(auth_phrase):
-    try:
-        resp = requests.get("https://api.bitbucket.org/2.0/teams/?role=member",
-                            headers=headers(auth_phrase)).json()
-    except ValueError:
-        return None
+def record_validators(resp, validators):
+    validators['url'] = resp.url
+    if resp.headers.get('ETag'):
+        validators['etag'] = resp.headers['ETag']
+    if resp.headers.get('Last-Modified'):
+        validators['last_modified'] = resp.headers['Last-Modified']
+
+
+def is_unchanged(validators, auth_phrase):
+    conditional_headers = headers(auth_phrase)
+    if validators.get('etag'):
+        conditional_headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        conditional_headers['If-Modified-Since'] = validators['last_modified']
+    if len(conditional_headers) == 1:
+        return False
+
+    resp = scheduler.get(validators['url'], conditional_headers)
+    return resp.status_code == 304
+
+
+def get_teams(auth_phrase, validators=None):
+    resp = fetch_json("{}/teams/?role=member".format(API_URL),
+                      headers(auth_phrase), validators)
     return [
         item["username"]
         for item in resp['values']
     ]
 
 
-def page_all(url, headers, extractor):
-    try:
-        results = []
-        num_results = 1
-        page = 1
-        while len(results) < num_results:
-            resp = (requests.get('{}page={}'.format(url, page), headers=headers)
-                    .json())
-            num_results = resp['size']
-            results += [
-                extractor(item)
-                for item in resp['values']
-            ]
-            page += 1
-    except ValueError:
-        return None
-    return results
+def get_page(url, headers, page, validators=None):
+    return fetch_json('{}page={}'.format(url, page), headers, validators)
+
 
+def page_all(url, headers, extractor, validators=None):
+    """Yield extractor(item) for every item of a paged listing, a page at a
+    time, so callers can start on the first page while later ones are still
+    being fetched."""
+    with metrics.span('page_all', url=urllib.parse.urlsplit(url).path) as span:
+        first = get_page(url, headers, 1, validators)
+        if validators is not None and first.get('next'):
+            # A validator for the first page says nothing about later pages
+            validators.clear()
 
-def get_projects(team, auth_phrase):
+        if 'size' in first and first.get('pagelen'):
+            # Once the total is known, every other page can be requested at
+            # once (ordered_map keeps only a bounded number in flight)
+            num_pages = int(math.ceil(first['size'] / float(first['pagelen'])))
+            pages = itertools.chain([first], ordered_map(
+                lambda page: get_page(url, headers, page),
+                range(2, num_pages + 1),
+                MAX_CONNECTIONS
+            ))
+        else:
+            pages = follow_next(first, headers)
+
+        span['pages'] = 0
+        for resp in pages:
+            span['pages'] += 1
+            for item in resp['values']:
+                yield extractor(item)
+
+
+def follow_next(resp, headers):
+    yield resp
+    while resp.get('next'):
+        resp = fetch_json(resp['next'], headers)
+        yield resp
+
+
+def repository_query(project=None, filters=()):
+    """Build a BBQL query for repositories in project (if given) matching
+    filters like 'name~api', 'language=python' or 'since=2024-01-01'."""
+    clauses = []
+    if project:
+        clauses.append('project.key="{}"'.format(quote_value(project)))
+    for repo_filter in filters:
+        match = REPOSITORY_FILTER.match(repo_filter)
+        if not match:
+            raise ValueError('Unknown repo filter "{}"'.format(repo_filter))
+        field, operator, value = match.group('field', 'operator', 'value')
+        if field == 'since':
+            clauses.append('updated_on>={}'.format(value))
+        else:
+            clauses.append('{}{}"{}"'.format(field, operator, quote_value(value)))
+    return ' AND '.join(clauses)
+
+
+def quote_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def listing_url(path, fields, query=None):
+    params = [('pagelen', PAGELEN), ('fields', fields)]
+    if query:
+        params.append(('q', query))
+    return '{}/{}?{}&'.format(API_URL, path, urllib.parse.urlencode(params))
+
+
+def get_projects(team, auth_phrase, validators=None):
     return page_all(
-        "https://api.bitbucket.org/2.0/teams/{}/projects/?".format(team),
+        listing_url('teams/{}/projects/'.format(team), PROJECT_FIELDS),
         headers(auth_phrase),
-        lambda item: '{}'.format(item['key'])
+        lambda item: '{}'.format(item['key']),
+        validators
     )
 
 
-def get_team_repositories(team, auth_phrase):
-    projects = get_projects(team, auth_phrase)
-    team_repositories = []
-
-    for project in projects:
-        print("Getting {}/{} repositories...".format(team, project))
-        team_repositories += get_project_repositories(team, project, auth_phrase)
-
-    return team_repositories
+def get_team_repositories(team, auth_phrase, filters=(), validators=None):
+    """Every repository of a team from the team-wide listing, in one paged
+    walk rather than one per project."""
+    return page_all(
+        listing_url('repositories/{}'.format(team), REPOSITORY_FIELDS,
+                    repository_query(filters=filters)),
+        headers(auth_phrase),
+        lambda item: '{}'.format(item['full_name']),
+        validators
+    )
 
 
-def get_project_repositories(team, project, auth_phrase):
+def get_project_repositories(team, project, auth_phrase, filters=(),
+                             validators=None):
     return page_all(
-        'https://api.bitbucket.org/2.0/repositories/{}?q=project.key="{}"&'.format(team, project),
+        listing_url('repositories/{}'.format(team), REPOSITORY_FIELDS,
+                    repository_query(project, filters)),
         headers(auth_phrase),
-        lambda item: '{}'.format(item['full_name'])
+        lambda item: '{}'.format(item['full_name']),
+        validators
     )
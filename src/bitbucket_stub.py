@@ -0,0 +1,185 @@
+"""A local stand-in for the parts of the Bitbucket 2.0 API that git-all uses.
+
+Serves teams, projects and repositories from a fixture of the form
+{team: {project: [repo, ...]}}, paginated like the real API. Point git-all at
+it with GIT_ALL_BITBUCKET_API=http://127.0.0.1:<port>/2.0.
+
+Faults can be injected to exercise retries: a fraction of requests can fail
+with a 503, and every Nth request can be throttled with a 429 and Retry-After.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PAGELEN = 10
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            request_number = server.request_count
+            fail = server.random.random() < server.fail_rate
+        if server.delay:
+            time.sleep(server.delay)
+
+        if server.throttle_every and request_number % server.throttle_every == 0:
+            server.throttled += 1
+            self.send_json(429, {'error': {'message': 'Rate limit exceeded'}},
+                           {'Retry-After': str(server.retry_after)})
+            return
+        if fail:
+            server.failed += 1
+            self.send_json(503, {'error': {'message': 'Service unavailable'}})
+            return
+
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = [part for part in url.path.split('/') if part]
+        if parts[:1] == ['2.0']:
+            parts = parts[1:]
+
+        items = self.lookup(parts, query)
+        if items is None:
+            self.send_json(404, {'error': {'message': 'Not found'}})
+            return
+        self.send_json(200, self.paginate(items, query))
+
+    def send_json(self, status, body, extra_headers=None):
+        data = json.dumps(body).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def lookup(self, parts, query):
+        fixture = self.server.fixture
+
+        if parts == ['teams']:
+            return [{'username': team} for team in sorted(fixture)]
+        if len(parts) == 3 and parts[0] == 'teams' and parts[2] == 'projects':
+            if parts[1] not in fixture:
+                return None
+            return [{'key': project} for project in sorted(fixture[parts[1]])]
+        if len(parts) == 2 and parts[0] == 'repositories':
+            team = parts[1]
+            if team not in fixture:
+                return None
+            project_match = re.search(r'project\.key="([^"]*)"', query.get('q', ''))
+            name_match = re.search(r'name~"([^"]*)"', query.get('q', ''))
+            projects = [project_match.group(1)] if project_match else sorted(fixture[team])
+            return [
+                {
+                    'full_name': '{}/{}'.format(team, repo),
+                    'project': {'key': project}
+                }
+                for project in projects
+                for repo in fixture[team].get(project, [])
+                if not name_match or name_match.group(1) in repo
+            ]
+        return None
+
+    def paginate(self, items, query):
+        pagelen = int(query.get('pagelen', DEFAULT_PAGELEN))
+        page = int(query.get('page', 1))
+        start = (page - 1) * pagelen
+        body = {
+            'size': len(items),
+            'page': page,
+            'pagelen': pagelen,
+            'values': items[start:start + pagelen]
+        }
+        if start + pagelen < len(items):
+            next_query = dict(query, page=str(page + 1))
+            body['next'] = 'http://{}:{}{}?{}'.format(
+                self.server.server_address[0], self.server.server_address[1],
+                urllib.parse.urlsplit(self.path).path,
+                urllib.parse.urlencode(next_query)
+            )
+        return body
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixture, port=0, delay=0, fail_rate=0, throttle_every=0,
+                 retry_after=1, seed=None):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.fixture = fixture
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.failed = 0
+        self.throttled = 0
+
+    @property
+    def api_url(self):
+        return 'http://{}:{}/2.0'.format(*self.server_address)
+
+
+def serve(fixture, port=0, delay=0, **faults):
+    """Start a stub server on a background thread and return it."""
+    server = StubServer(fixture, port, delay, **faults)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Bitbucket API.')
+    parser.add_argument('fixture', help='JSON file of {team: {project: [repo]}}')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Seconds of latency to add to every request')
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help='Fraction of requests to fail with a 503')
+    parser.add_argument('--throttle-every', type=int, default=0,
+                        help='Answer every Nth request with a 429')
+    parser.add_argument('--retry-after', type=float, default=1,
+                        help='Retry-After seconds to send with a 429')
+    args = parser.parse_args()
+
+    with open(args.fixture) as fixture_file:
+        fixture = json.load(fixture_file)
+    server = StubServer(fixture, args.port, args.delay,
+                        fail_rate=args.fail_rate,
+                        throttle_every=args.throttle_every,
+                        retry_after=args.retry_after)
+    print('Serving {}'.format(server.api_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,51 @@
+import os
+import sys
+
 import bitbucket_client
+import metrics
 import state
+from discovery_cache import DiscoveryCache
+from executor import ordered_map
+from job_history import JobHistory
+from mirror import Mirrors
+from ref_state import RefState
+from repo_scanner import RepoScanner
+from sync import SyncState
 
 
 class Controller:
-    def __init__(self):
+    def __init__(self, refresh=False):
         self.state = state.get_state()
+        self.discovery_cache = DiscoveryCache(
+            state.conf_path('discovery_cache.json'), refresh=refresh
+        )
+        self.repo_scanner = RepoScanner(state.conf_path('scan_cache.json'))
+        self.sync_state = SyncState(state.conf_path('sync_state.json'))
+        self.mirrors = Mirrors(state.conf_path('mirrors'))
+        self.job_history = JobHistory(state.conf_path('job_history.json'))
+        self.ref_state = RefState(state.conf_path('ref_state.json'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.commit()
+
+    def commit(self):
+        self.discovery_cache.save()
+        self.repo_scanner.save()
+        self.sync_state.save()
+        self.job_history.save()
+        self.ref_state.save()
+        self.state.commit()
+
+    def reload(self):
+        self.state.reload_if_changed()
+        self.discovery_cache.reload_if_changed()
+        self.repo_scanner.reload_if_changed()
+        self.sync_state.reload_if_changed()
+        self.job_history.reload_if_changed()
+        self.ref_state.reload_if_changed()
 
     def list_users(self):
         return self.state.list_users() or []
@@ -12,13 +53,12 @@ class Controller:
     def list_teams(self, user):
         auth_secret = self.state.get_user_credentials(user)
 
-        return bitbucket_client.get_teams(auth_secret)
-
-    def list_projects(self, user, team):
-        auth_secret = self.state.get_user_credentials(user)
+        return self.discovery_cache.lookup(
+            cache_key('teams', user),
+            lambda validators: bitbucket_client.get_teams(auth_secret, validators),
+            lambda validators: bitbucket_client.is_unchanged(validators, auth_secret)
+        )
 
-        return bitbucket_client.get_projects(team, auth_secret)
-    
     def add_user(self, user, auth_secret):
         self.state.update_user_credentials(user, auth_secret)
 
@@ -34,24 +74,42 @@ class Controller:
     def default_user(self):
         return self.state.get_default_user()
 
-    def get_repos_for_user(self, user):
-        repos = []
-        for team in sorted(self.list_teams(user)):
-            repos += self.get_repos_for_team(user, team)
-        return repos
+    def get_repos_for_user(self, user, filters=()):
+        # Teams are listed concurrently, and handed on one whole team at a time
+        for team_repos in ordered_map(
+                lambda team: list(self.get_repos_for_team(user, team, filters)),
+                sorted(self.list_teams(user)),
+                bitbucket_client.MAX_CONNECTIONS):
+            yield from team_repos
+
+    def get_repos_for_team(self, user, team, filters=()):
+        auth_secret = self.state.get_user_credentials(user)
+
+        def fetch(validators):
+            sys.stderr.write('Getting repos for team: {}\n'.format(team))
+            return bitbucket_client.get_team_repositories(
+                team, auth_secret, filters, validators
+            )
 
-    def get_repos_for_team(self, user, team):
-        repos = []
-        for project in sorted(self.list_projects(user, team)):
-            repos += self.get_repos_for_project(user, team, project)
-        return repos
+        return self.discovery_cache.lookup(
+            cache_key('team_repos', user, team, *filters),
+            fetch,
+            lambda validators: bitbucket_client.is_unchanged(validators, auth_secret)
+        ) or []
 
-    def get_repos_for_project(self, user, team, project):
-        print("Getting repos for project: {}:{}".format(team, project))
+    def get_repos_for_project(self, user, team, project, filters=()):
         auth_secret = self.state.get_user_credentials(user)
 
-        return bitbucket_client.get_project_repositories(
-            team, project, auth_secret
+        def fetch(validators):
+            sys.stderr.write('Getting repos for project: {}:{}\n'.format(team, project))
+            return bitbucket_client.get_project_repositories(
+                team, project, auth_secret, filters, validators
+            )
+
+        return self.discovery_cache.lookup(
+            cache_key('repos', user, team, project, *filters),
+            fetch,
+            lambda validators: bitbucket_client.is_unchanged(validators, auth_secret)
         )
 
     def list_repository_groups(self):
@@ -67,9 +125,13 @@ class Controller:
         self.state.add_to_repository_group(group_name, repos)
 
     def add_repo_path(self, repo, path):
+        path = os.path.abspath(path)
         self.state.set_repo_path(repo, path)
         self.state.add_repo_location(path, repo)
 
+    def drop_repo_path(self, repo, path):
+        self.state.remove_repo_location(path, repo)
+
     def list_repo_locations(self):
         return self.state.list_repo_locations()
 
@@ -78,3 +140,24 @@ class Controller:
 
     def get_repo_path(self, repo):
         return self.state.get_repo_path(repo)
+
+    def get_repo_paths(self, repos, location=None):
+        return self.state.get_repo_paths(repos, location)
+
+    def list_repo_registrations(self):
+        return self.state.list_repo_registrations()
+
+    def list_repo_paths(self):
+        return self.state.list_repo_paths()
+
+    def find_checkouts(self, repos, path):
+        repos = list(repos)
+        with metrics.span('find_checkouts', repos=len(repos)):
+            return self.repo_scanner.find_checkouts(repos, path)
+
+    def scan_checkouts(self, root):
+        return self.repo_scanner.scan(root)
+
+
+def cache_key(kind, *parts):
+    return ':'.join((kind,) + parts)
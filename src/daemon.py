@@ -0,0 +1,269 @@
+import contextvars
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import executor
+import state
+
+# Enough for one request line, whatever the size of the client's environment
+RECEIVE_SIZE = 64 * 1024
+
+
+def socket_path():
+    return state.conf_path('daemon.sock')
+
+
+def send(sock_file, message):
+    sock_file.write((json.dumps(message) + '\n').encode('utf-8'))
+    sock_file.flush()
+
+
+def settings(env):
+    """The GIT_ALL_* variables, which the daemon read once when it started."""
+    return {name: value for name, value in env.items() if name.startswith('GIT_ALL_')}
+
+
+def request(message):
+    """Send a single control message to a running daemon and return its reply,
+    or None if no daemon is listening."""
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path())
+    except OSError:
+        return None
+
+    with sock, sock.makefile('rwb') as sock_file:
+        send(sock_file, message)
+        reply = sock_file.readline()
+    return json.loads(reply.decode('utf-8')) if reply else None
+
+
+def forward(command, args, refresh):
+    """Run a parsed git-all command in the daemon. The daemon is handed this
+    process's stdin, stdout and stderr along with its environment and working
+    directory, and writes to them directly. Returns the command's exit status,
+    or None if no daemon is listening (or it won't take the command) and the
+    command should run in this process instead.
+
+    Closing the connection, e.g. on Ctrl-C, cancels the command.
+    """
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    except OSError:
+        return None
+
+    message = (json.dumps({
+        'command': command,
+        'args': args,
+        'refresh': refresh,
+        'env': dict(os.environ),
+        'cwd': os.getcwd()
+    }) + '\n').encode('utf-8')
+
+    with sock:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            sent = socket.send_fds(sock, [message], [0, 1, 2])
+        except OSError:
+            # Nothing reached the daemon, so the command can still run here
+            return None
+        # From here on the daemon may already be running the command, so it
+        # must not be run here as well
+        try:
+            if sent < len(message):
+                sock.sendall(message[sent:])
+            with sock.makefile('rb') as sock_file:
+                reply = sock_file.readline()
+        except OSError:
+            reply = None
+
+    if not reply:
+        sys.stderr.write('Lost connection to the git-all daemon\n')
+        return 1
+    reply = json.loads(reply.decode('utf-8'))
+    if 'refused' in reply:
+        return None
+    return reply['exit']
+
+
+def receive(sock):
+    """Read one request line and any file descriptors sent along with it."""
+    data, fds, _, _ = socket.recv_fds(sock, RECEIVE_SIZE, 3)
+    while data and not data.endswith(b'\n'):
+        more = sock.recv(RECEIVE_SIZE)
+        if not more:
+            break
+        data += more
+    return data, fds
+
+
+class ClientStream:
+    """Stands in for sys.stdin, sys.stdout or sys.stderr in the daemon,
+    passing everything through to that stream of the client the calling
+    command is running for."""
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def current(self):
+        client = executor.client.get()
+        return getattr(client, self.name) if client else self.default
+
+    def __getattr__(self, attribute):
+        return getattr(self.current(), attribute)
+
+    def __iter__(self):
+        return iter(self.current())
+
+
+class Daemon:
+    """Serves git-all commands over a unix socket from one long-lived process.
+
+    Each connection runs its command straight away in its own thread, so
+    commands run side by side; the state they share serializes its own
+    writes. Commands run with the client's environment, working directory
+    and standard streams, and are cancelled if the client disconnects.
+    """
+
+    def __init__(self, path, execute, stats):
+        self.path = path
+        self.execute = execute
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.stopping = threading.Event()
+        self.served = 0
+        self.started = time.time()
+        self.settings = settings(os.environ)
+
+    def status(self):
+        with self.lock:
+            running = len(self.clients)
+        status = {
+            'pid': os.getpid(),
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'served': self.served,
+            'queue_depth': running
+        }
+        status.update(self.stats())
+        return status
+
+    def serve(self):
+        import socketserver
+
+        daemon = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                line, fds = receive(self.request)
+                try:
+                    if not line.endswith(b'\n'):
+                        # The client went away before sending all of it
+                        return
+                    message = json.loads(line.decode('utf-8'))
+                    if message.get('status'):
+                        reply = daemon.status()
+                    elif message.get('shutdown'):
+                        daemon.stopping.set()
+                        reply = {'exit': 0}
+                    else:
+                        reply = daemon.run_job(self.request, message, fds)
+                        if 'exit' in reply:
+                            # Closed along with the job's streams
+                            fds = []
+                    self.request.sendall((json.dumps(reply) + '\n').encode('utf-8'))
+                except OSError:
+                    pass
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+
+        sys.stdin = ClientStream('stdin', sys.stdin)
+        sys.stdout = ClientStream('stdout', sys.stdout)
+        sys.stderr = ClientStream('stderr', sys.stderr)
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        server.daemon_threads = True
+        os.chmod(self.path, 0o600)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            self.stopping.wait()
+        finally:
+            with self.lock:
+                clients = list(self.clients)
+            for client in clients:
+                client.cancel()
+            server.shutdown()
+            server.server_close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def run_job(self, sock, message, fds):
+        if len(fds) != 3:
+            return {'refused': 'no standard streams were sent'}
+        if settings(message['env']) != self.settings:
+            return {'refused': 'started with different GIT_ALL_* settings'}
+
+        client = executor.Client(
+            message['env'], message['cwd'],
+            os.fdopen(fds[0], 'r'),
+            os.fdopen(fds[1], 'w', buffering=1),
+            os.fdopen(fds[2], 'w', buffering=1)
+        )
+        streams = [client.stdin, client.stdout, client.stderr]
+        finished = threading.Event()
+
+        def watch():
+            # The client sends nothing after its request, so this only
+            # returns once it has gone away
+            try:
+                sock.recv(1)
+            except OSError:
+                pass
+            if not finished.is_set():
+                # Stop writing to a terminal the user has moved on from
+                client.stdout = client.stderr = open(os.devnull, 'w')
+                streams.append(client.stdout)
+                client.cancel()
+
+        with self.lock:
+            self.clients.add(client)
+        threading.Thread(target=watch, daemon=True).start()
+        try:
+            status = contextvars.Context().run(self.run_for, client, message)
+        finally:
+            finished.set()
+            with self.lock:
+                self.clients.discard(client)
+                self.served += 1
+            for stream in streams:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        return {'exit': status or 0}
+
+    def run_for(self, client, message):
+        executor.client.set(client)
+        try:
+            return self.execute(message['command'], message['args'],
+                                message['refresh'])
+        except SystemExit as e:
+            return e.code if type(e.code) == int else int(e.code is not None)
+        except Exception:
+            traceback.print_exc()
+            return 1
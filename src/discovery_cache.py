@@ -0,0 +1,120 @@
+import contextvars
+import time
+
+from json_file import JsonFile
+
+DEFAULT_TTL = 60 * 60
+DEFAULT_MAX_ENTRIES = 2000
+USED_RESOLUTION = 60
+
+
+class DiscoveryCache(JsonFile):
+    def __init__(self, file_location, ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES, refresh=False):
+        super().__init__(file_location)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Per context, so that one --refresh run in the daemon doesn't make
+        # the runs going on alongside it refetch everything too
+        self.refresh_var = contextvars.ContextVar('refresh', default=False)
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def refresh(self):
+        return self.refresh_var.get()
+
+    @refresh.setter
+    def refresh(self, refresh):
+        self.refresh_var.set(refresh)
+
+    def lookup(self, key, fetch, is_unchanged=None):
+        """Return the cached listing for key, calling fetch(validators) to get
+        a fresh one when the entry is missing, expired or being refreshed.
+
+        An expired entry that carries validators is first revalidated with
+        is_unchanged(validators), which saves refetching every page of an
+        unchanged listing. If fetching fails, a stale entry is served instead.
+
+        fetch may return an iterator, which is passed through as it is
+        consumed and only cached once it has been read to the end.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry and not self.refresh:
+            if now - entry['fetched'] < self.ttl:
+                return self._hit(key, entry, now)
+            if entry.get('validators') and is_unchanged:
+                try:
+                    unchanged = is_unchanged(entry['validators'])
+                except IOError:
+                    unchanged = False
+                if unchanged:
+                    with self.lock:
+                        entry['fetched'] = now
+                        self.mark_changed(key)
+                    return self._hit(key, entry, now)
+
+        validators = {}
+        try:
+            value = fetch(validators)
+        except IOError:
+            if entry:
+                return self._hit(key, entry, now)
+            raise
+        if value is None:
+            return entry['value'] if entry else None
+        if not isinstance(value, list):
+            return self._stream(key, entry, value, validators, now)
+
+        self._store(key, value, validators, now)
+        return value
+
+    def _stream(self, key, entry, values, validators, now):
+        items = []
+        try:
+            for item in values:
+                items.append(item)
+                yield item
+        except IOError:
+            # Nothing has been handed out yet, so the stale entry can stand in
+            if entry and not items:
+                yield from self._hit(key, entry, now)
+                return
+            raise
+        self._store(key, items, validators, now)
+
+    def _store(self, key, value, validators, now):
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = {
+                'value': value,
+                'fetched': now,
+                'used': now,
+                'validators': validators
+            }
+            self.mark_changed(key)
+            self._evict()
+
+    def _hit(self, key, entry, now):
+        with self.lock:
+            self.hits += 1
+            # Recency only needs to be coarse for eviction, so a burst of
+            # cache hits doesn't turn into a burst of rewrites
+            if now - entry['used'] > USED_RESOLUTION:
+                entry['used'] = now
+                self.mark_changed(key)
+            self.entries[key] = entry
+        return entry['value']
+
+    def _evict(self):
+        overflow = len(self.entries) - self.max_entries
+        if overflow <= 0:
+            return
+        by_use = sorted(self.entries, key=lambda key: self.entries[key]['used'])
+        for key in by_use[:overflow]:
+            del self.entries[key]
+            self.mark_changed(key)
@@ -0,0 +1,562 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import metrics
+
+MAX_LINE_LENGTH = 64 * 1024
+# How long to wait for output to drain once a timed out command is killed
+KILL_GRACE = 5
+# How many items per job prioritized_map takes in ahead of the first one
+# whose result hasn't been handed on yet
+PRIORITY_LOOKAHEAD = 8
+
+# Process groups of the commands running right now, so they can all be killed
+# if git-all is interrupted
+running_groups = set()
+running_lock = threading.Lock()
+
+
+class Cancelled(OSError):
+    """Raised instead of starting a command once the client it would run
+    for has gone away. It's an OSError so that each repo fails the way it
+    would if the command couldn't be started, and the run winds down fast."""
+
+
+class Client:
+    """Whoever a command in the daemon is running for: commands it starts
+    get the client's environment, working directory and stdin rather than
+    the daemon's, and are killed if the client goes away."""
+
+    def __init__(self, env, cwd, stdin=None, stdout=None, stderr=None):
+        self.env = env
+        self.cwd = cwd
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.groups = set()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        with running_lock:
+            groups = list(self.groups)
+        for pgid in groups:
+            kill_group(pgid)
+
+
+# The client the current command runs for, in the daemon
+client = contextvars.ContextVar('client', default=None)
+# Whether commands are started in git-all's own process group, in front on
+# its terminal, rather than in a session of their own (see start_process)
+foreground = contextvars.ContextVar('foreground', default=False)
+
+
+def environ():
+    """The environment the current command was run with."""
+    current = client.get()
+    return current.env if current else os.environ
+
+
+def in_context(func):
+    """Wrap func to run in a copy of the current context, so a thread it is
+    handed to still knows which client it is working for."""
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+
+def run_command(command, path=None, timeout=None, nice=None):
+    with metrics.span('run_command', command=command_name(command)) as span:
+        out, error, status = _run_command(niced(command, nice), path, timeout)
+        span['ok'] = status == 0
+    return out, error, status
+
+
+@contextlib.contextmanager
+def terminal_access(one_at_a_time):
+    """Start commands in the foreground while this is active, if they run
+    one at a time and git-all was run from a terminal."""
+    interactive = sys.stdin is not None and sys.stdin.isatty()
+    token = foreground.set(one_at_a_time and interactive)
+    try:
+        yield
+    finally:
+        foreground.reset(token)
+
+
+def batch_env(env):
+    """env for a command that has no terminal to prompt on, so that git and
+    ssh fail straight away instead of waiting for a password, passphrase or
+    host key confirmation that can't be given. An ssh command the user has
+    set is left alone."""
+    env = dict(env)
+    env.setdefault('GIT_TERMINAL_PROMPT', '0')
+    if 'GIT_SSH_COMMAND' not in env and 'GIT_SSH' not in env:
+        env['GIT_SSH_COMMAND'] = 'ssh -o BatchMode=yes'
+    return env
+
+
+def start_process(command, path, **kwargs):
+    """Start command in its own process group, so that on timeout whatever
+    it has started (sh -c, build tools, the ssh under git fetch) can be
+    killed along with it.
+
+    A new session has no controlling terminal, so the command runs in batch
+    mode (see batch_env). Under terminal_access, it instead stays in
+    git-all's process group, where it can prompt on the terminal and Ctrl-C
+    reaches it directly.
+    """
+    current = client.get()
+    if current:
+        if current.cancelled.is_set():
+            raise Cancelled('Cancelled: the client went away')
+        kwargs.setdefault('env', current.env)
+        kwargs.setdefault('stdin', current.stdin)
+        kwargs.setdefault('stdout', current.stdout)
+        kwargs.setdefault('stderr', current.stderr)
+        path = path or current.cwd
+
+    if foreground.get() and not current:
+        return subprocess.Popen(command, cwd=path, **kwargs)
+
+    kwargs['env'] = batch_env(kwargs.get('env') or os.environ)
+    process = subprocess.Popen(command, cwd=path, start_new_session=True,
+                               **kwargs)
+    with running_lock:
+        running_groups.add(process.pid)
+        if current:
+            current.groups.add(process.pid)
+    if current and current.cancelled.is_set():
+        kill_group(process.pid)
+    return process
+
+
+def finish_process(process):
+    current = client.get()
+    with running_lock:
+        running_groups.discard(process.pid)
+        if current:
+            current.groups.discard(process.pid)
+
+
+def kill_process(process):
+    """Kill process along with its process group, unless it shares
+    git-all's."""
+    with running_lock:
+        own_group = process.pid in running_groups
+    if own_group:
+        kill_group(process.pid)
+    else:
+        process.kill()
+
+
+def kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def kill_running():
+    """Kill every command still running, e.g. when git-all is interrupted:
+    they are in their own process groups, so Ctrl-C doesn't reach them."""
+    with running_lock:
+        groups = list(running_groups)
+    for pgid in groups:
+        kill_group(pgid)
+
+
+def _run_command(command, path, timeout):
+    process = start_process(command, path, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    try:
+        out, error = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process(process)
+        try:
+            out, error = process.communicate(timeout=KILL_GRACE)
+        except subprocess.TimeoutExpired as e:
+            # Something escaped the group and still holds the pipes open
+            out, error = e.output or b'', e.stderr or b''
+            process.stdout.close()
+            process.stderr.close()
+            process.wait()
+        error += 'Timed out after {}s\n'.format(timeout).encode('utf-8')
+        return (out.decode('utf-8', 'replace'),
+                error.decode('utf-8', 'replace'),
+                None)
+    except BaseException:
+        # Interrupted while waiting, on the main thread
+        kill_process(process)
+        raise
+    finally:
+        finish_process(process)
+
+    return (out.decode('utf-8', 'replace'),
+            error.decode('utf-8', 'replace'),
+            process.returncode)
+
+
+def command_name(command):
+    """How a command is labelled in metrics: git and its subcommand, or
+    just the program for anything else."""
+    name = os.path.basename(command[0]) if command else ''
+    if name == 'git' and len(command) > 1:
+        return 'git ' + command[1]
+    return name
+
+
+def niced(command, nice):
+    # Via nice(1) rather than os.nice in a preexec_fn, which isn't safe to use
+    # while other threads are running
+    if not nice:
+        return command
+    return ['nice', '-n', str(nice)] + list(command)
+
+
+def stream_command(command, path=None, timeout=None, on_line=None,
+                   log_file=None, nice=None):
+    """Run command, handing each line of its output to on_line(stream, line)
+    and/or appending it to log_file as soon as it is read, instead of holding
+    the output in memory. Returns the exit code, or None on timeout."""
+    with metrics.span('run_command', command=command_name(command)) as span:
+        status = _stream_command(niced(command, nice), path, timeout, on_line,
+                                 log_file)
+        span['ok'] = status == 0
+    return status
+
+
+def _stream_command(command, path, timeout, on_line, log_file):
+    process = start_process(command, path, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    log_lock = threading.Lock()
+
+    def pump(pipe, stream):
+        for line in iter(lambda: pipe.readline(MAX_LINE_LENGTH), b''):
+            text = line.decode('utf-8', 'replace')
+            if log_file:
+                with log_lock:
+                    log_file.write(text)
+            if on_line:
+                on_line(stream, text)
+        pipe.close()
+
+    pumps = [
+        threading.Thread(target=in_context(pump),
+                         args=(process.stdout, 'stdout'), daemon=True),
+        threading.Thread(target=in_context(pump),
+                         args=(process.stderr, 'stderr'), daemon=True)
+    ]
+    for thread in pumps:
+        thread.start()
+
+    try:
+        status = process.wait(timeout=timeout)
+        deadline = None
+    except subprocess.TimeoutExpired:
+        kill_process(process)
+        process.wait()
+        status = None
+        deadline = time.monotonic() + KILL_GRACE
+    except BaseException:
+        kill_process(process)
+        raise
+    finally:
+        finish_process(process)
+    for thread in pumps:
+        # Once killed, don't wait forever on something that escaped the group
+        thread.join(None if deadline is None
+                    else max(0, deadline - time.monotonic()))
+
+    if status is None:
+        message = 'Timed out after {}s\n'.format(timeout)
+        if log_file:
+            log_file.write(message)
+        if on_line:
+            on_line('stderr', message)
+    return status
+
+
+class LinePrinter:
+    """Writes lines from many concurrent commands without interleaving them
+    mid-line, optionally prefixing each with the name of its source."""
+
+    def __init__(self, prefix=True):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+    def write(self, name, stream, line):
+        out = sys.stderr if stream == 'stderr' else sys.stdout
+        if not line.endswith('\n'):
+            line += '\n'
+        with self.lock:
+            if self.prefix:
+                out.write('[{}] '.format(name))
+            out.write(line)
+            out.flush()
+
+
+def batched(items, size):
+    """Yield lists of up to size items at a time from any iterable."""
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def ordered_map(func, items, jobs=None, priority=None):
+    """Apply func to items on a pool of `jobs` threads, yielding the results
+    in the order of items as soon as each one (and all before it) is done.
+
+    Items are pulled lazily and at most 2 * jobs calls are in flight at once.
+    If priority(item) is given, items are instead started highest priority
+    first, among those that have arrived (see prioritized_map).
+    """
+    jobs = jobs or default_jobs()
+    items = iter(items)
+
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    if priority:
+        yield from prioritized_map(func, items, jobs, priority, in_order=True)
+        return
+
+    # Imported here since it drags in logging, which purely local commands
+    # that never run anything concurrently shouldn't pay for at startup
+    import concurrent.futures
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(in_context(func), item))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def completed_map(func, items, jobs=None, priority=None):
+    """Like ordered_map, but yield each result as soon as it is done,
+    regardless of the order of items."""
+    jobs = jobs or default_jobs()
+    items = iter(items)
+
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    if priority:
+        yield from prioritized_map(func, items, jobs, priority, in_order=False)
+        return
+
+    import concurrent.futures
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+        for item in items:
+            pending.add(pool.submit(in_context(func), item))
+            if len(pending) >= jobs * 2:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+
+def prioritized_map(func, items, jobs, priority, in_order):
+    """Run func over items on `jobs` threads, always starting the highest
+    priority item that has arrived so far. items are pulled on a separate
+    thread, so work starts while a slow iterable is still producing more.
+    Results are yielded in the order of items if in_order, else as they
+    finish.
+
+    At most PRIORITY_LOOKAHEAD * jobs items are pulled ahead of the results
+    yielded so far, which bounds both how far priority can reorder items and
+    how many finished results are held back waiting for an earlier one.
+    """
+    import concurrent.futures
+
+    events = queue.Queue()
+    slots = threading.Semaphore(PRIORITY_LOOKAHEAD * jobs)
+    stopped = threading.Event()
+    end = object()
+
+    def feed():
+        try:
+            while True:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                item = next(items, end)
+                if item is end:
+                    break
+                events.put(('item', item))
+        except BaseException as e:
+            events.put(('error', e))
+        else:
+            events.put(('end', None))
+
+    threading.Thread(target=in_context(feed), daemon=True).start()
+
+    waiting = []
+    results = {}
+    running = 0
+    arrived = 0
+    next_index = 0
+    exhausted = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        try:
+            while not exhausted or waiting or running:
+                # Take in everything that has arrived before deciding what to
+                # start, so a burst of items is started in priority order
+                batch = [events.get()]
+                while True:
+                    try:
+                        batch.append(events.get_nowait())
+                    except queue.Empty:
+                        break
+                for kind, value in batch:
+                    if kind == 'item':
+                        heapq.heappush(waiting, (-priority(value), arrived, value))
+                        arrived += 1
+                    elif kind == 'done':
+                        running -= 1
+                        index, future = value
+                        results[index] = future
+                    elif kind == 'error':
+                        raise value
+                    else:
+                        exhausted = True
+
+                while waiting and running < jobs:
+                    _, index, item = heapq.heappop(waiting)
+                    future = pool.submit(in_context(func), item)
+                    future.add_done_callback(
+                        lambda future, index=index: events.put(('done', (index, future)))
+                    )
+                    running += 1
+
+                if in_order:
+                    while next_index in results:
+                        future = results.pop(next_index)
+                        next_index += 1
+                        slots.release()
+                        yield future.result()
+                else:
+                    for index in list(results):
+                        future = results.pop(index)
+                        slots.release()
+                        yield future.result()
+        finally:
+            # Let the feeder go if the caller stops early
+            stopped.set()
+            slots.release()
+
+
+class LoadGate:
+    """Holds back new jobs while the 1-minute load average is above max_load.
+
+    One job is always let through, so a host that is busy for other reasons
+    slows a run down rather than stalling it.
+    """
+
+    def __init__(self, max_load=None, interval=1.0):
+        self.max_load = max_load
+        self.interval = interval
+        self.running = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def slot(self):
+        while True:
+            with self.lock:
+                if (self.max_load is None or not self.running or
+                        os.getloadavg()[0] <= self.max_load):
+                    self.running += 1
+                    break
+            time.sleep(self.interval)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class Progress:
+    """A live "finished/running/failed" counter drawn on one terminal line."""
+
+    def __init__(self, total, stream=None):
+        self.total = total
+        self.stream = stream or sys.stderr
+        self.live = self.stream.isatty()
+        self.finished = 0
+        self.running = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def add(self, count=1):
+        """Grow the total, for work that is discovered as it goes."""
+        with self.lock:
+            self.total += count
+            self._draw()
+
+    def start(self):
+        with self.lock:
+            self.running += 1
+            self._draw()
+
+    def finish(self, ok):
+        with self.lock:
+            self.running -= 1
+            self.finished += 1
+            if not ok:
+                self.failed += 1
+            self._draw()
+
+    def write(self, message):
+        with self.lock:
+            if self.live:
+                self.stream.write('\r\033[K')
+                self.stream.flush()
+            print(message)
+            sys.stdout.flush()
+            self._draw()
+
+    def close(self):
+        with self.lock:
+            if self.live:
+                self.stream.write('\r\033[K')
+            self.stream.write(self._line() + '\n')
+            self.stream.flush()
+
+    def _line(self):
+        return '{}/{} finished, {} running, {} failed'.format(
+            self.finished, self.total, self.running, self.failed
+        )
+
+    def _draw(self):
+        if self.live:
+            self.stream.write('\r' + self._line())
+            self.stream.flush()
@@ -0,0 +1,93 @@
+import os
+
+from repo_scanner import find_common_dir, find_git_dir
+
+
+def read_packed_refs(common_dir):
+    """Return {ref: sha} from packed-refs. The commit an annotated tag
+    points at follows it on a '^' line, and is kept as 'ref^{}', the way
+    git show-ref -d lists it."""
+    refs = {}
+    ref = None
+    try:
+        with open(os.path.join(common_dir, 'packed-refs')) as packed_file:
+            for line in packed_file:
+                if line.startswith('#'):
+                    continue
+                if line.startswith('^'):
+                    if ref:
+                        refs[ref + '^{}'] = line[1:].strip()
+                    continue
+                parts = line.split()
+                ref = parts[1] if len(parts) == 2 else None
+                if ref:
+                    refs[ref] = parts[0]
+    except IOError:
+        pass
+    return refs
+
+
+def read_ref(common_dir, ref, packed_refs=None, peel=False):
+    """Return the sha ref (e.g. 'refs/heads/main') points at, from its loose
+    file or else packed-refs, or None if there is no such ref.
+
+    With peel, a packed annotated tag gives the commit it tags rather than
+    the tag object. Peeling a loose tag would mean reading the object
+    database, so those still give the tag object.
+    """
+    try:
+        with open(os.path.join(common_dir, *ref.split('/'))) as ref_file:
+            sha = ref_file.read().strip()
+        if not sha.startswith('ref:'):
+            return sha
+    except IOError:
+        pass
+    if packed_refs is None:
+        packed_refs = read_packed_refs(common_dir)
+    if peel and ref + '^{}' in packed_refs:
+        return packed_refs[ref + '^{}']
+    return packed_refs.get(ref)
+
+
+def read_refs(checkout, prefix):
+    """Return {ref: sha} for every ref under prefix (e.g. 'refs/remotes/origin/'),
+    read straight from the loose ref files and packed-refs."""
+    git_dir = find_git_dir(checkout)
+    if not git_dir:
+        return {}
+    common_dir = find_common_dir(git_dir)
+
+    refs = {
+        ref: sha
+        for ref, sha in read_packed_refs(common_dir).items()
+        if ref.startswith(prefix) and not ref.endswith('^{}')
+    }
+    ref_root = os.path.join(common_dir, *prefix.rstrip('/').split('/'))
+    for directory, subdirectories, files in os.walk(ref_root):
+        for file_name in files:
+            ref_file = os.path.join(directory, file_name)
+            ref = os.path.relpath(ref_file, common_dir).replace(os.sep, '/')
+            try:
+                with open(ref_file) as ref_contents:
+                    sha = ref_contents.read().strip()
+            except IOError:
+                continue
+            if not sha.startswith('ref:'):
+                refs[ref] = sha
+    return refs
+
+
+def read_head(checkout):
+    """Return the branch checked out in checkout, or None if HEAD is detached
+    or the checkout can't be read."""
+    git_dir = find_git_dir(checkout)
+    if not git_dir:
+        return None
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as head_file:
+            head = head_file.read().strip()
+    except IOError:
+        return None
+    if head.startswith('ref: refs/heads/'):
+        return head[len('ref: refs/heads/'):]
+    return None
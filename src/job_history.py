@@ -0,0 +1,87 @@
+import os
+import time
+
+from json_file import JsonFile
+from repo_scanner import find_common_dir, find_git_dir
+
+# How much each new duration moves a repo's running average
+SMOOTHING = 0.3
+SIZE_TTL = 24 * 60 * 60
+
+
+def pack_size(checkout):
+    """Bytes of packed objects in a checkout: cheap to measure, since packs
+    are a handful of large files, and most of a repo's weight on disk."""
+    git_dir = find_git_dir(checkout)
+    if not git_dir:
+        return None
+    pack_dir = os.path.join(find_common_dir(git_dir), 'objects', 'pack')
+    try:
+        with os.scandir(pack_dir) as entries:
+            return sum(entry.stat().st_size for entry in entries
+                       if entry.name.endswith('.pack'))
+    except OSError:
+        return None
+
+
+class JobHistory(JsonFile):
+    """Per-repo running averages of how long each command takes there, plus
+    each repo's size on disk, so the slowest work can be started first."""
+
+    def __init__(self, file_location):
+        super().__init__(file_location)
+        self.rates = {}
+
+    def _retrieve_entries(self):
+        # Rates are worked out from the entries, so start over with new ones
+        self.rates = {}
+        return super()._retrieve_entries()
+
+    def record(self, repo, command, seconds):
+        with self.lock:
+            durations = self.entries.setdefault(repo, {}).setdefault('seconds', {})
+            previous = durations.get(command)
+            durations[command] = round(
+                seconds if previous is None
+                else previous + SMOOTHING * (seconds - previous),
+                6
+            )
+            self.rates.pop(command, None)
+            self.mark_changed(repo)
+
+    def record_size(self, repo, checkout):
+        entry = self.entries.get(repo, {})
+        if time.time() - entry.get('size_checked', 0) < SIZE_TTL:
+            return
+        size = pack_size(checkout)
+        with self.lock:
+            entry = self.entries.setdefault(repo, {})
+            entry['size'] = size
+            entry['size_checked'] = time.time()
+            self.mark_changed(repo)
+
+    def expected(self, repo, command):
+        """Expected seconds for command in repo: its own history if there is
+        some, else its size at the rate the command runs elsewhere. Repos
+        nothing is known about sort ahead of everything else."""
+        entry = self.entries.get(repo, {})
+        seconds = entry.get('seconds', {}).get(command)
+        if seconds is not None:
+            return seconds
+        rate = self._rate(command)
+        if rate is not None and entry.get('size') is not None:
+            return entry['size'] * rate
+        return float('inf')
+
+    def _rate(self, command):
+        """Seconds per byte of pack for command, over every repo where both
+        are known."""
+        with self.lock:
+            if command not in self.rates:
+                seconds, size = 0.0, 0
+                for entry in self.entries.values():
+                    if command in entry.get('seconds', {}) and entry.get('size'):
+                        seconds += entry['seconds'][command]
+                        size += entry['size']
+                self.rates[command] = seconds / size if size else None
+            return self.rates[command]
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+
+
+class JsonFile:
+    """A dict of entries kept in a JSON file under conf/, for the caches and
+    histories that are loaded once per run and written back at the end.
+
+    Subclasses change self.entries while holding self.lock and call
+    mark_changed() with each key they set or remove; save() only writes when
+    something has changed. Other processes may save the same file in the
+    meantime, so their entries are merged in rather than written over. A
+    file that can't be read or written just means starting from nothing
+    next time.
+    """
+
+    def __init__(self, file_location):
+        self.file_location = file_location
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.changed_keys = set()
+        self.loaded_mtime = self._mtime()
+        self.entries = self._retrieve_entries()
+
+    def mark_changed(self, key):
+        self.changed_keys.add(key)
+        self.dirty = True
+
+    def reload_if_changed(self):
+        """Pick up writes from other processes, for long-lived instances."""
+        with self.lock:
+            self._merge()
+
+    def _merge(self):
+        mtime = self._mtime()
+        if mtime == self.loaded_mtime:
+            return
+        self.loaded_mtime = mtime
+        entries = self._retrieve_entries()
+        for key in self.changed_keys:
+            if key in self.entries:
+                entries[key] = self.entries[key]
+            else:
+                entries.pop(key, None)
+        self.entries = entries
+
+    def _mtime(self):
+        try:
+            return os.stat(self.file_location).st_mtime_ns
+        except OSError:
+            return None
+
+    def _retrieve_entries(self):
+        try:
+            with open(self.file_location) as entries_file:
+                entries = json.load(entries_file)
+        except (IOError, ValueError):
+            entries = {}
+        return entries
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:
+            self._merge()
+            # Write a sibling file and rename it over the old one, so a crash
+            # mid-write leaves the previous entries rather than a torn file
+            temp_location = '{}.{}.tmp'.format(self.file_location, os.getpid())
+            try:
+                with open(temp_location, 'w') as entries_file:
+                    json.dump(self.entries, entries_file)
+                    entries_file.flush()
+                    os.fsync(entries_file.fileno())
+                os.replace(temp_location, self.file_location)
+            except IOError:
+                try:
+                    os.unlink(temp_location)
+                except OSError:
+                    pass
+                return
+            self.loaded_mtime = self._mtime()
+            self.changed_keys = set()
+            self.dirty = False
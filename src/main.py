@@ -1,26 +1,47 @@
 import argparse
 import base64
 import getpass
+import json
 import os
+import shlex
 import subprocess
 import sys
+import time
 
+import metrics
+import state
 from controller import Controller
+from executor import (LinePrinter, LoadGate, Progress, batched, command_name,
+                      completed_map, default_jobs, kill_running, ordered_map,
+                      run_command, stream_command, terminal_access)
+from repo_set import RepoSetResolver
+
+
+TOP_LEVEL_OPTIONS_WITH_VALUES = ('--profile',)
+# How many streamed repos to look up in the registry or on disk at once
+BATCH_SIZE = 100
+RUN_LOG = 'run_log.ndjson'
 
 
 def setup_commands():
     return {
         'users': {
             'run': Commands.show_user_info,
-            'help': 'List stored users'
+            'help': 'List stored users',
+            # Only reads local state, so there is nothing worth timing
+            'record': False
         },
         'groups': {
             'run': Commands.show_group_info,
-            'help': 'List stored groups'
+            'help': 'List stored groups',
+            # Only reads local state, so there is nothing worth timing
+            'record': False
         },
         'repos': {
             'run': Commands.show_repository_info,
-            'help': 'List installed repositories'
+            'help': 'List installed repositories',
+            # Only reads local state, so there is nothing worth timing
+            'record': False
         },
         'do': {
             'run': Commands.run_in_repos,
@@ -33,6 +54,83 @@ def setup_commands():
                 'quiet': {
                     'flag': '-q',
                     'help': "Don't print any output"
+                },
+                'stream': {
+                    'flag': ['-s', '--stream'],
+                    'help': 'Print output line by line as it arrives, '
+                            'prefixed with the repo name'
+                },
+                'dirty': {
+                    'flag': '--dirty',
+                    'help': 'Only run in repos with uncommitted or untracked '
+                            'changes'
+                }
+            },
+            'options': {
+                'output_format': {
+                    'flag': '--format',
+                    'choices': ['text', 'json', 'ndjson'],
+                    'default': 'text',
+                    'help': 'Print plain output, or one JSON record per repo '
+                            'with exit code, timing and output'
+                },
+                'log_dir': {
+                    'flag': '--log-dir',
+                    'path': True,
+                    'help': "Write each repo's full output to a log file "
+                            "in this directory"
+                },
+                'jobs': {
+                    'flag': ['-j', '--jobs'],
+                    'type': int,
+                    'help': 'How many repos to run the command in at once '
+                            '(by default, one per CPU)'
+                },
+                'timeout': {
+                    'flag': ['-t', '--timeout'],
+                    'type': float,
+                    'help': 'Seconds to wait for the command in each repo'
+                },
+                'location': {
+                    'flag': '-l',
+                    'path': True,
+                    'help': 'Use the checkouts registered under this directory '
+                            "(by default, each repo's latest registered checkout)"
+                },
+                'script': {
+                    'flag': '--script',
+                    'path': True,
+                    'help': 'Run each command in this file, one per line, in '
+                            'every repo, stopping at the first that fails'
+                },
+                'max_load': {
+                    'flag': '--max-load',
+                    'type': float,
+                    'help': "Don't start another repo while the 1-minute load "
+                            'average is above this'
+                },
+                'nice': {
+                    'flag': '--nice',
+                    'type': int,
+                    'help': 'Run the command at this niceness (1-19 lowers '
+                            'its CPU and I/O priority)'
+                },
+                'changed_since': {
+                    'flag': '--changed-since',
+                    'help': 'Only run in repos whose HEAD has moved since a '
+                            'date (2024-05-01, yesterday, 36h) or is not at '
+                            'a ref (e.g. origin/main)'
+                },
+                'branch': {
+                    'flag': '--branch',
+                    'help': 'Only run in repos with this branch (or glob) '
+                            'checked out'
+                },
+                'workers': {
+                    'flag': '--workers',
+                    'help': 'Split the repos across these workers, comma '
+                            'separated: ssh hosts (HOST or ssh:HOST), or '
+                            'local[:CONF_DIR] to run a shard on this machine'
                 }
             },
             'args': [
@@ -42,7 +140,8 @@ def setup_commands():
                 },
                 {
                     'name': 'action',
-                    'help': 'The command action to perform in each repo',
+                    'help': 'The command action to perform in each repo '
+                            '(unless --script is given)',
                     'type': 'remainder'
                 }
             ]
@@ -53,6 +152,8 @@ def setup_commands():
             'options': {
                 'path': {
                     'flag': '-l',
+                    'path': True,
+                    'default': '.',
                     'help': 'Where the repo(s) to register are located'
                 }
             },
@@ -63,9 +164,40 @@ def setup_commands():
                 }
             ]
         },
+        'scan': {
+            'run': Commands.scan_repositories,
+            'help': 'Register every bitbucket repository checked out under a directory',
+            'args': [
+                {
+                    'name': 'directory',
+                    'help': 'The directory to search',
+                    'path': True,
+                    'default': '.'
+                }
+            ]
+        },
+        'prune': {
+            'run': Commands.prune_repositories,
+            'help': 'Forget registered checkouts that no longer exist',
+            'flags': {
+                'dry_run': {
+                    'flag': ['-n', '--dry-run'],
+                    'help': 'Only show what would be forgotten'
+                }
+            },
+            'options': {
+                'jobs': {
+                    'flag': ['-j', '--jobs'],
+                    'type': int,
+                    'default': 8,
+                    'help': 'How many checkouts to check at once'
+                }
+            }
+        },
         'add-user': {
             'run': Commands.add_credentials,
             'help': 'Store new bitbucket credentials',
+            'forward': False,
             'args': [
                 {
                     'name': 'user',
@@ -122,13 +254,183 @@ def setup_commands():
                 }
             ]
         },
+        'sync': {
+            'run': Commands.sync_repositories,
+            'help': 'Fetch and fast-forward the installed repos whose remotes changed',
+            'flags': {
+                'fetch_only': {
+                    'flag': '--fetch-only',
+                    'help': "Fetch, but don't fast-forward the checked out branch"
+                }
+            },
+            'options': {
+                'jobs': {
+                    'flag': ['-j', '--jobs'],
+                    'type': int,
+                    'default': 8,
+                    'help': 'How many repos to sync at once'
+                },
+                'timeout': {
+                    'flag': ['-t', '--timeout'],
+                    'type': float,
+                    'help': 'Seconds to wait for each git command'
+                }
+            },
+            'args': [
+                {
+                    'name': 'repo_names',
+                    'help': 'The repo(s) to sync (all installed repos by default)',
+                    'default': None
+                }
+            ]
+        },
+        'status': {
+            'run': Commands.show_status,
+            'help': 'Show branch, ahead/behind and dirty state for installed repos',
+            'flags': {
+                'dirty': {
+                    'flag': '--dirty',
+                    'help': 'Only show repos with uncommitted or untracked changes'
+                },
+                'behind': {
+                    'flag': '--behind',
+                    'help': 'Only show repos that are behind their upstream'
+                }
+            },
+            'options': {
+                'output_format': {
+                    'flag': '--format',
+                    'choices': ['table', 'json', 'ndjson'],
+                    'default': 'table',
+                    'help': 'How to print the results'
+                },
+                'jobs': {
+                    'flag': ['-j', '--jobs'],
+                    'type': int,
+                    'default': default_jobs(),
+                    'help': 'How many repos to check at once'
+                }
+            },
+            'args': [
+                {
+                    'name': 'repo_names',
+                    'help': 'The repo(s) to check (all installed repos by default)',
+                    'default': None
+                }
+            ]
+        },
+        'mirror': {
+            'run': Commands.manage_mirrors,
+            'help': 'Manage local mirrors that installs borrow objects from',
+            'options': {
+                'jobs': {
+                    'flag': ['-j', '--jobs'],
+                    'type': int,
+                    'default': 8,
+                    'help': 'How many mirrors to update at once'
+                }
+            },
+            'args': [
+                {
+                    'name': 'mirror_action',
+                    'help': 'update: create or refresh mirrors; list: show mirrors',
+                    'choices': ['update', 'list']
+                },
+                {
+                    'name': 'repo_names',
+                    'help': 'The repo(s) to mirror (by default, every installed '
+                            'or already mirrored repo)',
+                    'default': None
+                }
+            ]
+        },
+        'stats': {
+            'run': Commands.show_stats,
+            'help': 'Summarize timings from the log of recent runs',
+            'record': False,
+            'options': {
+                'runs': {
+                    'flag': '--runs',
+                    'type': int,
+                    'default': 100,
+                    'help': 'How many of the most recent runs to look at'
+                },
+                'top': {
+                    'flag': '--top',
+                    'type': int,
+                    'default': 10,
+                    'help': 'How many of the slowest repos to show'
+                },
+                'output_format': {
+                    'flag': '--format',
+                    'choices': ['table', 'json'],
+                    'default': 'table',
+                    'help': 'Print tables, or the whole summary as JSON'
+                },
+                'openmetrics': {
+                    'flag': '--openmetrics',
+                    'path': True,
+                    'help': 'Also write the summary to this file in the '
+                            'OpenMetrics text format, e.g. for the node '
+                            "exporter's textfile collector"
+                }
+            }
+        },
+        'daemon': {
+            'run': Commands.run_daemon,
+            'help': 'Manage a background process that serves git-all commands',
+            'forward': False,
+            'record': False,
+            'args': [
+                {
+                    'name': 'daemon_action',
+                    'help': 'What to do with the daemon',
+                    'choices': ['start', 'stop', 'status', 'run'],
+                    'default': 'status'
+                }
+            ]
+        },
         'install': {
             'run': Commands.install_repositories,
             'help': 'Clone repositories in a specified location',
             'options': {
                 'path': {
                     'flag': '-l',
+                    'path': True,
+                    'default': '.',
                     'help': 'where to install the repos'
+                },
+                'jobs': {
+                    'flag': ['-j', '--jobs'],
+                    'type': int,
+                    'default': 4,
+                    'help': 'How many repos to clone at once'
+                },
+                'depth': {
+                    'flag': '--depth',
+                    'type': int,
+                    'help': 'Create shallow clones with this many commits'
+                },
+                'clone_filter': {
+                    'flag': '--filter',
+                    'help': 'Partial clone filter, e.g. blob:none'
+                },
+                'reference': {
+                    'flag': '--reference',
+                    'path': True,
+                    'help': 'A local mirror to borrow objects from '
+                            '(instead of the managed mirrors)'
+                }
+            },
+            'flags': {
+                'no_mirror': {
+                    'flag': '--no-mirror',
+                    'help': "Don't borrow objects from managed mirrors"
+                },
+                'dissociate': {
+                    'flag': '--dissociate',
+                    'help': 'Copy borrowed objects into each clone, so it '
+                            "doesn't depend on the mirror afterwards"
                 }
             },
             'args': [
@@ -141,11 +443,33 @@ def setup_commands():
     }
 
 
-def setup_parser(commands):
+def requested_command(commands, argv):
+    skip_next = False
+    for token in argv:
+        if skip_next:
+            skip_next = False
+        elif token in TOP_LEVEL_OPTIONS_WITH_VALUES:
+            skip_next = True
+        elif not token.startswith('-'):
+            return token if token in commands else None
+    return None
+
+
+def setup_parser(commands, argv=None):
+    # Only the subcommand being run needs its arguments set up; the others just
+    # need to exist so they show up in usage and help
+    selected = requested_command(commands, sys.argv[1:] if argv is None else argv)
+
     parser = argparse.ArgumentParser(
         prog='git-all',
         description='A utility for managing a set of bitbucket repositories.'
     )
+    parser.add_argument('--refresh',
+                        action='store_true',
+                        help='Ignore cached bitbucket team/project/repo listings')
+    parser.add_argument('--profile',
+                        metavar='FILE',
+                        help='Write cProfile stats for the command to FILE')
     subparsers = parser.add_subparsers(
         dest='command',
         description='A set of git-all commands',
@@ -156,6 +480,8 @@ def setup_parser(commands):
         subcommand_parser = subparsers.add_parser(command_name,
                                                   description=command.get('help'),
                                                   help=command.get('help'))
+        if selected and command_name != selected:
+            continue
 
         for arg in command.get('args', []):
             if type(arg) == str:
@@ -166,6 +492,7 @@ def setup_parser(commands):
                         arg['name'],
                         help=arg.get('help'),
                         nargs='?',
+                        choices=arg.get('choices'),
                         default=arg.get('default')
                     )
                 elif arg.get('type') == 'remainder':
@@ -177,23 +504,50 @@ def setup_parser(commands):
                 else:
                     subcommand_parser.add_argument(
                         arg['name'],
+                        choices=arg.get('choices'),
                         help=arg.get('help')
                     )
 
         for option_name, option in command.get('options', {}).items():
-            subcommand_parser.add_argument(option['flag'],
+            subcommand_parser.add_argument(*option_flags(option),
                                            dest=option_name,
                                            help=option.get('help'),
+                                           type=option.get('type'),
+                                           choices=option.get('choices'),
                                            default=option.get('default'))
 
         for flag_name, flag in command.get('flags', {}).items():
-            subcommand_parser.add_argument(flag['flag'],
+            subcommand_parser.add_argument(*option_flags(flag),
                                            dest=flag_name,
                                            help=flag.get('help'),
                                            action='store_true')
     return parser
 
 
+def option_flags(option):
+    if type(option['flag']) == str:
+        return [option['flag']]
+    return option['flag']
+
+
+def read_script(location):
+    """Read a `do --script` file (- for stdin): one command per line, split
+    like a shell would but without running one. Blank lines and # comments
+    are skipped."""
+    if location == '-':
+        return parse_script(sys.stdin)
+    with open(location) as script_file:
+        return parse_script(script_file)
+
+
+def parse_script(lines):
+    return [
+        shlex.split(line)
+        for line in lines
+        if line.strip() and not line.lstrip().startswith('#')
+    ]
+
+
 def get_auth(username):
     password = getpass.getpass("Password: ")
 
@@ -201,21 +555,10 @@ def get_auth(username):
     return base64.standard_b64encode(unencoded_auth_secret.encode('utf-8')).decode('utf-8')
 
 
-def run_command(command, path=None):
-    process = subprocess.Popen(command,
-                               cwd=path,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    out, error = process.communicate()
-    
-    return (out.decode('utf-8'),
-            error.decode('utf-8'),
-            process.returncode)
-            
-
 class Commands:
     def __init__(self, controller):
         self.controller = controller
+        self.resolver = RepoSetResolver(controller)
 
     def parse_users(self, users):
         if not users:
@@ -232,42 +575,12 @@ class Commands:
         return groups.split(',')
 
     def parse_repos(self, repos):
-        final_repos = []
-
-        for repo_str in repos.split(','):
-            if repo_str.startswith('/'):
-                group_repos = self.controller.list_repository_group(repo_str[1:])
-                final_repos += group_repos
-            elif repo_str.startswith('@'):
-                repo_params = repo_str[1:].split('/')
-                user = repo_params[0]
-                if not user:
-                    user = self.controller.default_user()
-                if not user:
-                    print('Cannot parse repo "{}"'.format(repo_str))
-                    continue
+        return self.resolver.resolve(repos)
+
+    def iter_repos(self, repos):
+        """Like parse_repos, but yield repos as soon as they are found."""
+        return self.resolver.iter_resolve(repos)
 
-                if len(repo_params) == 1:
-                    got_repos = self.controller.get_repos_for_user(
-                        user
-                    )
-                elif len(repo_params) == 2:
-                    team = repo_params[1]
-                    got_repos = self.controller.get_repos_for_team(
-                        user, team
-                    )
-                else:
-                    team = repo_params[1]
-                    project = repo_params[2]
-                    got_repos = self.controller.get_repos_for_project(
-                        user, team, project
-                    )
-                if got_repos:
-                    final_repos += got_repos
-            else:
-                final_repos.append(repo_str)
-        return final_repos
-        
     def add_credentials(self, user):
         if not user:
             user = input("Username: ")
@@ -309,55 +622,134 @@ class Commands:
                 print('  {}'.format(repo))
 
     def add_repositories(self, group_names, repo_names):
-        repos = self.parse_repos(repo_names)
+        groups = self.parse_groups(group_names)
+        repos = self.iter_repos(repo_names)
+        if len(groups) > 1:
+            repos = list(repos)
 
-        for group in self.parse_groups(group_names):
+        for group in groups:
             self.controller.add_to_repository_group(group, repos)
 
     def check_for_repo(self, repo, path):
-        repo_name = repo.split('/')[-1]
-        path = os.path.join(path, repo_name)
+        with metrics.span('check_for_repo', repo=repo) as span:
+            span['found'] = repo in self.controller.find_checkouts([repo], path)
+        return span['found']
 
-        output = ''
-        try:
-            output, error, status = run_command(['git', 'remote', 'get-url', 'origin'], path)
-        except FileNotFoundError:
-            pass
-        
-        if 'git@bitbucket.org:{}'.format(repo) in output:
-            return True
-        return False
-            
-    def clone_repo(self, repo, path):
-        output, error, status = run_command(['git', 'clone', 'git@bitbucket.org:{}.git'.format(repo)], path)
-        if status != 0:
-            print(error)
+    def clone_repo(self, repo, path, clone_args=()):
+        output, error, status = run_command(
+            ['git', 'clone'] + list(clone_args) +
+            ['git@bitbucket.org:{}.git'.format(repo)],
+            path
+        )
+        return status, error
 
     def register_repositories(self, repo_names, path):
-        if path is None:
-            path = os.getcwd()
-
-        for repo in sorted(self.parse_repos(repo_names)):
-            if not self.check_for_repo(repo, path):
+        repos = sorted(self.parse_repos(repo_names))
+        found = self.controller.find_checkouts(repos, path)
+        for repo in repos:
+            if repo not in found:
                 print('No repository found: {}'.format(repo))
                 continue
-                
+
             print('Registering {}'.format(repo))
-            self.controller.add_repo_path(repo, path)            
-            
-    def install_repositories(self, repo_names, path):
-        if path is None:
-            path = os.getcwd()
-
-        for repo in sorted(self.parse_repos(repo_names)):
-            if self.check_for_repo(repo, path):
-                print('Repository already found: {}, registering...'.format(repo))
+            self.controller.add_repo_path(repo, path)
+
+    def scan_repositories(self, directory):
+        for repo, checkout in self.controller.scan_checkouts(os.path.abspath(directory)):
+            location, checkout_name = os.path.split(checkout)
+            if checkout_name != repo.split('/')[-1]:
+                print('Skipping {}: checked out as {}'.format(repo, checkout))
+                continue
+
+            print('Registering {} at {}'.format(repo, location))
+            self.controller.add_repo_path(repo, location)
+
+    def install_repositories(self, repo_names, path, jobs, depth,
+                             clone_filter, reference, no_mirror, dissociate):
+        clone_args = []
+        if depth:
+            clone_args += ['--depth', str(depth)]
+        if clone_filter:
+            clone_args += ['--filter={}'.format(clone_filter)]
+        if dissociate:
+            clone_args += ['--dissociate']
+
+        def reference_args(repo):
+            if reference:
+                return ['--reference-if-able', reference]
+            mirror = None if no_mirror else self.controller.mirrors.get(repo)
+            return ['--reference', mirror] if mirror else []
+
+        progress = Progress(0)
+        history = self.controller.job_history
+
+        def candidates():
+            # Repos stream in from discovery, so check for existing checkouts
+            # a batch at a time and start cloning as soon as the first arrive
+            for batch in batched(self.iter_repos(repo_names), BATCH_SIZE):
+                found = self.controller.find_checkouts(batch, path)
+                for repo in batch:
+                    if repo not in found:
+                        progress.add()
+                    yield repo, repo in found
+
+        def priority(candidate):
+            repo, found = candidate
+            # Registering a found repo is instant, so get it out of the way
+            return float('inf') if found else history.expected(repo, 'git clone')
+
+        def install(candidate):
+            repo, found = candidate
+            if found:
+                return repo, found, 0, None
+
+            with metrics.context(repo=repo):
+                progress.start()
+                start = time.perf_counter()
+                status, error = self.clone_repo(repo, path,
+                                                clone_args + reference_args(repo))
+                progress.finish(status == 0)
+            if status == 0:
+                history.record(repo, 'git clone', time.perf_counter() - start)
+                history.record_size(repo, os.path.join(path, repo.split('/')[-1]))
+            return repo, found, status, error
+
+        # Start the biggest clones first so a large repo doesn't start last
+        # and hold up the whole install
+        for repo, found, status, error in ordered_map(install, candidates(),
+                                                      jobs, priority):
+            if found:
+                progress.write(
+                    'Repository already found: {}, registering...'.format(repo)
+                )
                 self.controller.add_repo_path(repo, path)
                 continue
-                
-            print('Cloning {}'.format(repo))
-            self.clone_repo(repo, path)
+            if status != 0:
+                progress.write('Failed to clone {}:\n{}'.format(repo, error))
+                continue
+            progress.write('Cloned {}'.format(repo))
             self.controller.add_repo_path(repo, path)
+        progress.close()
+
+        return min(progress.failed, 125)
+
+    def prune_repositories(self, dry_run, jobs):
+        def check(registration):
+            repo, path = registration
+            return repo, path, self.check_for_repo(repo, path)
+
+        pruned = 0
+        for repo, path, exists in ordered_map(
+                check, self.controller.list_repo_registrations(), jobs):
+            if exists:
+                continue
+            print('Forgetting {} at {}'.format(repo, path))
+            if not dry_run:
+                self.controller.drop_repo_path(repo, path)
+            pruned += 1
+        print('{} stale checkout(s) {}'.format(
+            pruned, 'found' if dry_run else 'forgotten'
+        ))
 
     def show_repository_info(self):
         for location in sorted(self.controller.list_repo_locations()):
@@ -365,45 +757,589 @@ class Commands:
             for repo in self.controller.get_repos_at(location):
                 print('  {}'.format(repo))
 
-    def run_in_repos(self, repo_names, action, quiet, clean):
-        for repo in self.parse_repos(repo_names):
-            repo_location = self.controller.get_repo_path(repo)
+    def run_in_repos(self, repo_names, action, quiet, clean, stream, log_dir,
+                     output_format, jobs, timeout, location, script, max_load,
+                     nice, workers, changed_since, branch, dirty):
+        import results
+        from ref_state import has_moved, on_branch, parse_since
+        from repo_status import is_dirty
+        from workers import make_transport, run_sharded
+
+        if stream and output_format != 'text':
+            sys.stderr.write('--stream can only be used with --format text\n')
+            return 2
+        if bool(script) == bool(action):
+            sys.stderr.write('Give either a command to run or --script, '
+                             'but not both\n')
+            return 2
+        if workers and stream:
+            sys.stderr.write("--stream can't be used with --workers\n")
+            return 2
+
+        if script:
+            try:
+                commands = read_script(script)
+            except IOError as e:
+                sys.stderr.write('Could not read script: {}\n'.format(e))
+                return 2
+            if not commands:
+                sys.stderr.write('{} has no commands to run\n'.format(script))
+                return 2
+        else:
+            commands = [action]
+        if workers:
+            try:
+                transports = [make_transport(spec) for spec in workers.split(',')]
+            except ValueError as e:
+                sys.stderr.write('{}\n'.format(e))
+                return 2
+        # What durations are remembered under, to start the slowest repos first
+        if script:
+            job = 'script {}'.format(os.path.basename(script))
+        else:
+            job = command_name(action)
+        history = self.controller.job_history
+        gate = LoadGate(max_load)
+
+        # Only once the arguments are known to be good: the JSON writer
+        # starts its output straight away
+        writer = results.make_writer(output_format, quiet, clean, stream,
+                                     bool(log_dir))
+        repos = self.iter_repos(repo_names)
+
+        if workers:
+            def shard_argv(shard_repos):
+                argv = ['do', '--format', 'ndjson']
+                for flag, value in (('-j', jobs), ('-t', timeout),
+                                    ('-l', location), ('--log-dir', log_dir),
+                                    ('--max-load', max_load), ('--nice', nice),
+                                    ('--changed-since', changed_since),
+                                    ('--branch', branch)):
+                    if value is not None:
+                        argv += [flag, str(value)]
+                if dirty:
+                    argv.append('--dirty')
+                if script:
+                    argv += ['--script', '-']
+                return argv + [','.join(shard_repos)] + ([] if script else action)
+
+            # Rebuilt from what was parsed, as a script on stdin has already
+            # been read
+            script_text = None
+            if script:
+                script_text = '\n'.join(shlex.join(command)
+                                        for command in commands) + '\n'
+            repos = sorted(repos, key=lambda repo: history.expected(repo, job),
+                           reverse=True)
+            for record in run_sharded(transports, repos, shard_argv, script_text):
+                if record.pop('skipped', False):
+                    writer.skip(record)
+                    continue
+                if record.get('seconds') is not None:
+                    history.record(record['repo'], job, record['seconds'])
+                writer.write(record)
+            return writer.close()
+
+        if location:
+            location = os.path.abspath(location)
+
+        since = parse_since(changed_since) if changed_since else None
+        ref_state = self.controller.ref_state
+
+        def selected(repo_path):
+            # Read from the files under .git, so narrowing a large set of
+            # repos doesn't mean running git in each of them
+            if not since and not branch:
+                return True
+            checkout_state = ref_state.read(
+                repo_path, [since[1]] if since and since[0] == 'ref' else []
+            )
+            if checkout_state is None:
+                return True
+            return ((not since or has_moved(checkout_state, since)) and
+                    (not branch or on_branch(checkout_state, branch)))
+
+        def find_targets():
+            for batch in batched(repos, BATCH_SIZE):
+                repo_paths = self.controller.get_repo_paths(batch, location)
+                with metrics.span('select_checkouts', repos=len(batch)):
+                    targets = []
+                    for repo in batch:
+                        repo_location = repo_paths.get(repo)
+                        if not repo_location:
+                            targets.append((repo, None, True))
+                            continue
+                        short_repo_name = repo.split('/')[-1]
+                        repo_path = '{}/{}'.format(repo_location, short_repo_name)
+                        targets.append((repo, repo_path, selected(repo_path)))
+                yield from targets
 
-            if not repo_location:
-                print('{} is not installed'.format(repo))
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        printer = LinePrinter(prefix=not clean)
+
+        def log_path(repo):
+            return os.path.join(log_dir, '{}.log'.format(repo.replace('/', '.')))
+
+        def stream_steps(repo, repo_path, log_file=None):
+            on_line = None
+            if stream and not quiet:
+                on_line = lambda name, line: printer.write(repo, name, line)
+
+            for command in commands:
+                step_start = time.perf_counter()
+                status = stream_command(command, repo_path, timeout, on_line,
+                                        log_file, nice)
+                yield command, status, '', '', step_start
+
+        def run_steps(repo, repo_path):
+            for command in commands:
+                step_start = time.perf_counter()
+                output, error, status = run_command(command, repo_path, timeout,
+                                                    nice)
+                yield command, status, output, error, step_start
+
+        def has_changes(repo_path):
+            try:
+                return is_dirty(repo_path, timeout)
+            except OSError:
+                # e.g. the checkout has been deleted: run_in_repo reports why
+                return True
+
+        def run_target(target):
+            repo, repo_path, wanted = target
+            if not repo_path:
+                record = {'repo': repo, 'exit_code': None, 'error': 'not installed'}
+                if location:
+                    record['location'] = location
+                return record
+            # Working tree changes don't touch anything under .git that could
+            # be cached, so --dirty has to ask git, and is checked last
+            if not wanted or (dirty and not has_changes(repo_path)):
+                return {'repo': repo, 'skipped': True}
+
+            with metrics.context(repo=repo), gate.slot():
+                record = run_in_repo(repo, repo_path)
+            history.record(repo, job, record['seconds'])
+            history.record_size(repo, repo_path)
+            return record
+
+        def run_in_repo(repo, repo_path):
+            record = {'repo': repo}
+            outputs, errors, steps = [], [], []
+            start = time.perf_counter()
+            status = None
+            log_file = None
+            try:
+                if log_dir:
+                    record['log'] = log_path(repo)
+                    log_file = open(record['log'], 'w')
+                if stream or log_dir:
+                    run = stream_steps(repo, repo_path, log_file)
+                else:
+                    run = run_steps(repo, repo_path)
+                # Each step only runs once the one before it has succeeded
+                for command, status, output, error, step_start in run:
+                    outputs.append(output)
+                    errors.append(error)
+                    steps.append({
+                        'command': command,
+                        'exit_code': status,
+                        'seconds': round(time.perf_counter() - step_start, 6)
+                    })
+                    if status != 0:
+                        break
+            except OSError as e:
+                errors.append('{}\n'.format(e))
+                status = None
+            finally:
+                if log_file:
+                    log_file.close()
+
+            output, error = ''.join(outputs), ''.join(errors)
+            record.update(
+                exit_code=status,
+                seconds=round(time.perf_counter() - start, 6),
+                stdout=output,
+                stderr=error,
+                stdout_bytes=len(output.encode('utf-8')),
+                stderr_bytes=len(error.encode('utf-8'))
+            )
+            if script:
+                record['steps'] = steps
+            return record
+
+        # Machine-readable results go out as soon as each repo finishes;
+        # text output stays in the order the repos were given
+        run_all = ordered_map if output_format == 'text' else completed_map
+        for record in run_all(run_target, find_targets(), jobs,
+                              lambda target: history.expected(target[0], job)):
+            if record.pop('skipped', False):
+                writer.skip(record)
                 continue
+            writer.write(record)
+        return writer.close()
+
+    def sync_repositories(self, repo_names, fetch_only, jobs, timeout):
+        from sync import sync_checkout
+
+        if repo_names:
+            repos = self.parse_repos(repo_names)
+            repo_paths = self.controller.get_repo_paths(repos)
+        else:
+            repo_paths = self.controller.list_repo_paths()
+            repos = sorted(repo_paths)
+        sync_state = self.controller.sync_state
 
-            short_repo_name = repo.split('/')[-1]
-            output, error, status = run_command(action, '{}/{}'.format(
-                repo_location, short_repo_name
-            ))
-            if quiet:
+        def sync(repo):
+            with metrics.context(repo=repo):
+                if not repo_paths.get(repo):
+                    return repo, {'status': 'failed', 'error': 'not installed'}
+                checkout = os.path.join(repo_paths[repo], repo.split('/')[-1])
+                try:
+                    return repo, sync_checkout(checkout, sync_state.last_seen(repo),
+                                               not fetch_only, timeout)
+                except OSError as e:
+                    return repo, {'status': 'failed', 'error': str(e)}
+
+        counts = {'unchanged': 0, 'fetched': 0, 'updated': 0, 'failed': 0}
+        for repo, result in ordered_map(sync, repos, jobs):
+            counts[result['status']] += 1
+            sync_state.record(repo, result)
+            if result['status'] != 'unchanged':
+                print('{}: {}'.format(repo, result['status']))
+            if result.get('error'):
+                print('  ' + result['error'].strip().replace('\n', '\n  '))
+
+        print('{updated} updated, {fetched} fetched, {unchanged} unchanged, '
+              '{failed} failed'.format(**counts))
+        return min(counts['failed'], 125)
+
+    def show_status(self, repo_names, dirty, behind, output_format, jobs):
+        from repo_status import collect_status, format_age
+
+        if repo_names:
+            repos = self.parse_repos(repo_names)
+            repo_paths = self.controller.get_repo_paths(repos)
+        else:
+            repo_paths = self.controller.list_repo_paths()
+            repos = sorted(repo_paths)
+
+        def check(repo):
+            with metrics.context(repo=repo):
+                if not repo_paths.get(repo):
+                    return repo, {'error': 'not installed'}
+                checkout = os.path.join(repo_paths[repo], repo.split('/')[-1])
+                try:
+                    return repo, collect_status(checkout)
+                except OSError as e:
+                    return repo, {'error': str(e)}
+
+        width = max([len(repo) for repo in repos] + [4])
+        row = '{:<%d}  {:<20}  {:>5}  {:>6}  {:>7}  {:>9}  {:>6}' % width
+        if output_format == 'table':
+            print(row.format('repo', 'branch', 'ahead', 'behind', 'changed',
+                             'untracked', 'commit'))
+
+        results = []
+        now = time.time()
+        for repo, status in ordered_map(check, repos, jobs):
+            if 'error' not in status:
+                if dirty and not status['dirty']:
+                    continue
+                if behind and not status['behind']:
+                    continue
+            elif dirty or behind:
                 continue
-            
-            if error or output:
-                if clean:
-                    sys.stdout.write(error or output)
-                else:
-                    print('{}:'.format(repo))
-                    print(error or output)
 
+            record = dict(status, repo=repo)
+            if output_format == 'ndjson':
+                print(json.dumps(record, sort_keys=True))
+                sys.stdout.flush()
+            elif output_format == 'json':
+                results.append(record)
+            elif 'error' in status:
+                print('{:<{}}  error: {}'.format(repo, width, status['error']))
+            else:
+                print(row.format(repo, status['branch'] or '(detached)',
+                                 status['ahead'], status['behind'],
+                                 status['changed'], status['untracked'],
+                                 format_age(status['last_commit'], now)))
 
-def main():
-    try:
-        commands = setup_commands()
-        parser = setup_parser(commands)
-        args = parser.parse_args()
+        if output_format == 'json':
+            print(json.dumps(results, indent=2, sort_keys=True))
 
-        command = args.command
-        command_args = vars(args)
-        command_args.pop('command')
+    def manage_mirrors(self, mirror_action, repo_names, jobs):
+        mirrors = self.controller.mirrors
 
-        if command == None: # annoying python 3 thing
-            print(parser.format_usage())
+        if mirror_action == 'list':
+            for repo in mirrors.list():
+                print('{}: {}'.format(repo, mirrors.location(repo)))
             return
-        
-        command_runner = Commands(Controller())
-        command_method = commands[command]['run']
-        command_method.__get__(command_runner)(**command_args)
+
+        if repo_names:
+            repos = self.parse_repos(repo_names)
+        else:
+            repos = sorted(set(self.controller.list_repo_paths()) |
+                           set(mirrors.list()))
+
+        progress = Progress(len(repos))
+
+        def update(repo):
+            with metrics.context(repo=repo):
+                progress.start()
+                try:
+                    status, error = mirrors.update(repo)
+                except OSError as e:
+                    status, error = None, str(e)
+                progress.finish(status == 0)
+                return repo, status, error
+
+        for repo, status, error in ordered_map(update, repos, jobs):
+            if status != 0:
+                progress.write('Failed to mirror {}:\n{}'.format(repo, error))
+        progress.close()
+        return min(progress.failed, 125)
+
+    def show_stats(self, runs, top, output_format, openmetrics):
+        summary = metrics.summarize(
+            metrics.read_runs(state.conf_path(RUN_LOG), runs), top
+        )
+
+        if openmetrics:
+            temp_location = '{}.{}.tmp'.format(openmetrics, os.getpid())
+            with open(temp_location, 'w') as metrics_file:
+                metrics_file.write(metrics.format_openmetrics(summary))
+            os.replace(temp_location, openmetrics)
+
+        if output_format == 'json':
+            print(json.dumps(summary, indent=2, sort_keys=True))
+            return
+
+        def seconds(value):
+            return '-' if value is None else '{:.3f}'.format(value)
+
+        def table(title, groups, extra=None):
+            if not groups:
+                return
+            width = max([len(name) for name, timings in groups] + [len(title)])
+            row = '{:<%d}  {:>6}  {:>6}  {:>8}  {:>8}  {:>8}' % width
+            print(row.format(title, 'count', 'failed', 'p50', 'p95', 'max') +
+                  ('  {:>8}'.format(extra[0]) if extra else ''))
+            for name, timings in groups:
+                print(row.format(name, timings['count'], timings['failed'],
+                                 seconds(timings['p50']), seconds(timings['p95']),
+                                 seconds(timings['max'])) +
+                      ('  {:>8}'.format(extra[1](timings)) if extra else ''))
+            print('')
+
+        print('{} runs\n'.format(summary['runs']))
+        table('command', sorted(summary['commands'].items()),
+              ('api/run', lambda timings: timings['api_requests']['mean']))
+        table('span', sorted(summary['spans'].items()))
+        table('run in repos', sorted(summary['run_commands'].items(),
+                                     key=lambda item: -(item[1]['p95'] or 0)))
+        table('slowest repos', summary['slowest_repos'].items())
+
+    def run_daemon(self, daemon_action):
+        import daemon
+
+        path = daemon.socket_path()
+
+        if daemon_action == 'run':
+            commands = setup_commands()
+            daemon.Daemon(
+                path,
+                lambda command, command_args, refresh: dispatch(
+                    commands, command, refresh, command_args, command_runner=self
+                ),
+                self.daemon_stats
+            ).serve()
+        elif daemon_action == 'start':
+            if daemon.request({'status': True}):
+                print('The git-all daemon is already running')
+                return
+            subprocess.Popen(
+                [sys.executable, os.path.join(os.path.dirname(__file__), '__main__.py'),
+                 'daemon', 'run'],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True
+            )
+            for _ in range(50):
+                if daemon.request({'status': True}):
+                    print('Started the git-all daemon')
+                    return
+                time.sleep(0.1)
+            print('The git-all daemon failed to start')
+            return 1
+        elif daemon_action == 'stop':
+            if daemon.request({'shutdown': True}) is None:
+                print('The git-all daemon is not running')
+        else:
+            status = daemon.request({'status': True})
+            if status is None:
+                print('The git-all daemon is not running')
+                return 1
+            print(json.dumps(status, indent=2, sort_keys=True))
+
+    def daemon_stats(self):
+        import bitbucket_client
+
+        cache = self.controller.discovery_cache
+        resolver = self.resolver
+        return {
+            'discovery_cache': {
+                'hits': cache.hits,
+                'misses': cache.misses,
+                'hit_rate': hit_rate(cache.hits, cache.misses)
+            },
+            'repo_sets': {
+                'hits': resolver.hits,
+                'misses': resolver.misses,
+                'hit_rate': hit_rate(resolver.hits, resolver.misses)
+            },
+            'bitbucket': dict(bitbucket_client.scheduler.counters)
+        }
+
+
+def hit_rate(hits, misses):
+    if not hits + misses:
+        return None
+    return round(hits / float(hits + misses), 3)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        return execute(argv)
     except KeyboardInterrupt:
-        pass
+        kill_running()
+        return 130
+
+
+def execute(argv):
+    commands = setup_commands()
+    parser = setup_parser(commands, argv)
+    args = parser.parse_args(argv)
+
+    command = args.command
+    command_args = vars(args)
+    command_args.pop('command')
+    refresh = command_args.pop('refresh')
+    profile = command_args.pop('profile')
+
+    if command == None: # annoying python 3 thing
+        print(parser.format_usage())
+        return
+
+    resolve_paths(commands[command], command_args)
+
+    if (not profile and commands[command].get('forward', True) and
+            not os.environ.get('GIT_ALL_NO_DAEMON')):
+        import daemon
+
+        status = daemon.forward(command, command_args, refresh)
+        if status is not None:
+            return status
+
+    return dispatch(commands, command, refresh, command_args, profile)
+
+
+def resolve_paths(command, command_args):
+    """Make the command's path arguments absolute, so they mean the same
+    thing when the command runs in the daemon."""
+    for name, option in list(command.get('options', {}).items()) + [
+            (arg['name'], arg) for arg in command.get('args', [])
+            if type(arg) != str]:
+        value = command_args.get(name)
+        if option.get('path') and value and value != '-':
+            command_args[name] = os.path.abspath(value)
+
+
+def dispatch(commands, command, refresh, command_args, profile=None,
+             command_runner=None):
+    """Run a parsed command and add it to the run log."""
+    import bitbucket_client
+
+    api_counters = dict(bitbucket_client.scheduler.counters)
+    started = time.time()
+    status = None
+    metrics.recorder.begin()
+    try:
+        if profile:
+            status = profiled(profile, run, commands[command], refresh,
+                              command_args, command_runner)
+        else:
+            status = run(commands[command], refresh, command_args,
+                         command_runner)
+        return status
+    except bitbucket_client.BitbucketError as e:
+        sys.stderr.write('Bitbucket error: {}\n'.format(e))
+        status = 1
+        return status
+    finally:
+        api_requests = report_api_counters(api_counters)
+        if commands[command].get('record', True):
+            record_run(command, started, status, api_requests)
+
+
+def report_api_counters(before):
+    import bitbucket_client
+
+    counters = {
+        name: value - before[name]
+        for name, value in bitbucket_client.scheduler.counters.items()
+    }
+    if counters['retries'] or counters['throttled']:
+        sys.stderr.write(
+            'Bitbucket: {requests} requests, {retries} retried, '
+            '{throttled} throttled\n'.format(**counters)
+        )
+    return counters['requests']
+
+
+def record_run(command, started, status, api_requests):
+    metrics.append_run(state.conf_path(RUN_LOG), {
+        'command': command,
+        'started': round(started, 3),
+        'seconds': round(time.time() - started, 6),
+        # Commands that finish normally return None
+        'exit': status or 0,
+        'api_requests': api_requests,
+        'spans': metrics.recorder.take()
+    })
+
+
+def run(command, refresh, command_args, command_runner=None):
+    if command_runner:
+        # Running inside the daemon: reuse its long-lived controller, but
+        # expand repo sets afresh, so groups and discovery stay current
+        controller = command_runner.controller
+        controller.reload()
+        controller.discovery_cache.refresh = refresh
+        job_runner = Commands(controller)
+        try:
+            return command['run'].__get__(job_runner)(**command_args)
+        finally:
+            controller.commit()
+            command_runner.resolver.add_counts(job_runner.resolver)
+
+    with Controller(refresh=refresh) as controller:
+        command_runner = Commands(controller)
+        # With -j1, whatever the command starts can prompt on this terminal
+        with terminal_access(command_args.get('jobs') == 1):
+            return command['run'].__get__(command_runner)(**command_args)
+
+
+def profiled(profile_location, func, *args):
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(profile_location)
+        sys.stderr.write('Profile written to {}\n'.format(profile_location))
@@ -0,0 +1,208 @@
+"""Spans timing git-all's hot paths, kept in an append-only run log.
+
+Each span records a name, a duration, whether it succeeded and a few
+attributes. At the end of every command the spans are appended to the run log
+as one JSON line, which `git-all stats` aggregates.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+
+from results import percentile
+
+# Once the log grows past this, it is moved aside and a new one started
+MAX_LOG_BYTES = 8 * 1024 * 1024
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = []
+        # Runs started with begin() collect their own spans, so runs going on
+        # at once in the daemon don't get each other's
+        self.run_spans = contextvars.ContextVar('run_spans', default=None)
+
+    def begin(self):
+        self.run_spans.set([])
+
+    def record(self, name, seconds, ok=True, **attributes):
+        span = dict(getattr(self.local, 'attributes', {}), **attributes)
+        span.update(span=name, seconds=round(seconds, 6), ok=ok)
+        with self.lock:
+            self._spans().append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Time the block as a span. Set attributes['ok'] inside the block to
+        record an outcome other than "didn't raise"."""
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException:
+            attributes['ok'] = False
+            raise
+        finally:
+            ok = attributes.pop('ok', True)
+            self.record(name, time.perf_counter() - start, ok, **attributes)
+
+    @contextlib.contextmanager
+    def context(self, **attributes):
+        """Add attributes, like the repo being worked on, to every span this
+        thread records inside the block."""
+        previous = getattr(self.local, 'attributes', {})
+        self.local.attributes = dict(previous, **attributes)
+        try:
+            yield
+        finally:
+            self.local.attributes = previous
+
+    def take(self):
+        with self.lock:
+            spans = self._spans()
+            taken = list(spans)
+            del spans[:]
+        return taken
+
+    def _spans(self):
+        spans = self.run_spans.get()
+        return self.spans if spans is None else spans
+
+
+recorder = Recorder()
+span = recorder.span
+context = recorder.context
+
+
+def append_run(log_location, run):
+    line = json.dumps(run, separators=(',', ':'), sort_keys=True) + '\n'
+    try:
+        if os.path.getsize(log_location) > MAX_LOG_BYTES:
+            os.replace(log_location, log_location + '.1')
+    except OSError:
+        pass
+    try:
+        # A single write to a file opened for appending, so runs from
+        # concurrent processes don't interleave mid-line
+        with open(log_location, 'a') as log_file:
+            log_file.write(line)
+    except IOError:
+        pass
+
+
+def read_runs(log_location, limit=None):
+    runs = []
+    try:
+        with open(log_location) as log_file:
+            for line in log_file:
+                try:
+                    runs.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        pass
+    return runs[-limit:] if limit else runs
+
+
+def distribution(seconds, failures=0):
+    return {
+        'count': len(seconds),
+        'failed': failures,
+        'p50': percentile(seconds, 0.5),
+        'p95': percentile(seconds, 0.95),
+        'max': max(seconds) if seconds else None
+    }
+
+
+def summarize(runs, top=10):
+    """Aggregate runs into per-command, per-span and per-repo timings."""
+    def group(items, key):
+        groups = {}
+        for item in items:
+            entry = groups.setdefault(key(item), ([], []))
+            entry[0].append(item['seconds'])
+            if not item.get('ok', True):
+                entry[1].append(item)
+        return {
+            name: distribution(seconds, len(failures))
+            for name, (seconds, failures) in groups.items()
+        }
+
+    spans = [span for run in runs for span in run.get('spans', [])]
+    commands = group(
+        [dict(run, ok=not run.get('exit')) for run in runs],
+        lambda run: run['command']
+    )
+    for name, timings in commands.items():
+        api_requests = [run.get('api_requests', 0) for run in runs
+                        if run['command'] == name]
+        timings['api_requests'] = {
+            'mean': round(sum(api_requests) / float(len(api_requests)), 1),
+            'max': max(api_requests)
+        }
+
+    repos = group([span for span in spans
+                   if span['span'] == 'run_command' and 'repo' in span],
+                  lambda span: span['repo'])
+    slowest = sorted(repos.items(), key=lambda item: item[1]['p50'],
+                     reverse=True)[:top]
+
+    return {
+        'runs': len(runs),
+        'commands': commands,
+        'spans': group(spans, lambda span: span['span']),
+        'run_commands': group(
+            [span for span in spans if span['span'] == 'run_command'],
+            lambda span: span.get('command', '?')
+        ),
+        'slowest_repos': dict(slowest)
+    }
+
+
+def format_openmetrics(summary):
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('# HELP {} {}'.format(name, help_text))
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append('{}{{{}}} {}'.format(name, ','.join(
+                '{}="{}"'.format(label, str(label_value)
+                                 .replace('\\', '\\\\').replace('"', '\\"'))
+                for label, label_value in labels
+            ), value))
+
+    def quantiles(label, groups):
+        return [
+            (((label, name), ('quantile', quantile)), timings[key])
+            for name, timings in sorted(groups.items())
+            for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'))
+        ]
+
+    family('git_all_command_seconds', 'gauge',
+           'Duration of recent git-all runs by command',
+           quantiles('command', summary['commands']))
+    family('git_all_command_failures', 'gauge',
+           'Failed recent git-all runs by command',
+           [((('command', name),), timings['failed'])
+            for name, timings in sorted(summary['commands'].items())])
+    family('git_all_api_requests', 'gauge',
+           'Mean bitbucket API requests per run by command',
+           [((('command', name),), timings['api_requests']['mean'])
+            for name, timings in sorted(summary['commands'].items())])
+    family('git_all_span_seconds', 'gauge',
+           'Duration of instrumented operations',
+           quantiles('span', summary['spans']))
+    family('git_all_run_command_seconds', 'gauge',
+           'Duration of commands run in repos',
+           quantiles('command', summary['run_commands']))
+    family('git_all_repo_seconds', 'gauge',
+           'Duration of commands in the slowest repos',
+           quantiles('repo', summary['slowest_repos']))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,47 @@
+import os
+
+from executor import run_command
+
+
+class Mirrors:
+    """Bare mirrors of bitbucket repos, keyed by full_name, that clones can
+    borrow objects from instead of downloading them again."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def location(self, repo):
+        return os.path.join(self.root, *repo.split('/')) + '.git'
+
+    def get(self, repo):
+        location = self.location(repo)
+        return location if os.path.isdir(location) else None
+
+    def list(self):
+        mirrored = []
+        if not os.path.isdir(self.root):
+            return mirrored
+        for team in sorted(os.listdir(self.root)):
+            team_dir = os.path.join(self.root, team)
+            if not os.path.isdir(team_dir):
+                continue
+            for name in sorted(os.listdir(team_dir)):
+                if name.endswith('.git'):
+                    mirrored.append('{}/{}'.format(team, name[:-len('.git')]))
+        return mirrored
+
+    def update(self, repo, timeout=None):
+        """Create or refresh the mirror of repo. Returns (status, error)."""
+        location = self.location(repo)
+        if os.path.isdir(location):
+            output, error, status = run_command(
+                ['git', 'remote', 'update', '--prune'], location, timeout
+            )
+        else:
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            output, error, status = run_command(
+                ['git', 'clone', '--mirror', '--quiet',
+                 'git@bitbucket.org:{}.git'.format(repo), location],
+                None, timeout
+            )
+        return status, error
@@ -0,0 +1,178 @@
+"""Cheap answers to "which branch is this checkout on, and has it moved?".
+
+Everything is read straight from the files under .git (HEAD, its reflog and
+the ref files) rather than by running git, and each checkout's answer is
+remembered until one of the files it was read from changes.
+"""
+import datetime
+import fnmatch
+import os
+import re
+import time
+
+from git_refs import read_packed_refs, read_ref
+from json_file import JsonFile
+from repo_scanner import find_common_dir, find_git_dir
+
+# Where a short ref name is looked for, in the order git looks
+REF_CANDIDATES = ('refs/{}', 'refs/tags/{}', 'refs/heads/{}', 'refs/remotes/{}')
+RELATIVE_SINCE = re.compile(r'^(\d+)([mhdw])$')
+UNITS = {'m': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M',
+                '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')
+SHA = re.compile(r'^[0-9a-f]{40}$')
+# How far from the end of a reflog to look for its last entry
+REFLOG_TAIL_BYTES = 4096
+
+
+def parse_since(value, now=None):
+    """Turn a --changed-since value into ('time', timestamp) for dates like
+    2024-05-01, 'yesterday' or 36h, or ('ref', name) for anything else."""
+    now = now or time.time()
+    match = RELATIVE_SINCE.match(value)
+    if match:
+        return 'time', now - int(match.group(1)) * UNITS[match.group(2)]
+    if value in ('today', 'yesterday'):
+        midnight = datetime.datetime.fromtimestamp(now).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        if value == 'yesterday':
+            midnight -= datetime.timedelta(days=1)
+        return 'time', midnight.timestamp()
+    for date_format in DATE_FORMATS:
+        try:
+            return 'time', datetime.datetime.strptime(value, date_format).timestamp()
+        except ValueError:
+            continue
+    return 'ref', value
+
+
+def last_reflog_time(reflog_location):
+    """The timestamp of the last entry in a reflog, read from its tail."""
+    try:
+        with open(reflog_location, 'rb') as reflog_file:
+            reflog_file.seek(0, os.SEEK_END)
+            reflog_file.seek(max(0, reflog_file.tell() - REFLOG_TAIL_BYTES))
+            lines = reflog_file.read().splitlines()
+    except IOError:
+        return None
+    for line in reversed(lines):
+        # <old> <new> <name> <email> <timestamp> <tz>\t<message>
+        fields = line.split(b'\t', 1)[0].rsplit(b' ', 2)
+        if len(fields) == 3:
+            try:
+                return int(fields[1])
+            except ValueError:
+                continue
+    return None
+
+
+def mtime(location):
+    try:
+        return os.stat(location).st_mtime_ns
+    except OSError:
+        return None
+
+
+def read_checkout(git_dir, refs):
+    """Read HEAD, when it last moved and the shas of refs, along with the
+    mtime of every file that was (or would have been) read."""
+    common_dir = find_common_dir(git_dir)
+    stamps = {}
+
+    def stamp(location):
+        stamps[location] = mtime(location)
+        return location
+
+    packed_refs = read_packed_refs(common_dir)
+    stamp(os.path.join(common_dir, 'packed-refs'))
+
+    def resolve(ref):
+        stamp(os.path.join(common_dir, *ref.split('/')))
+        # Tags are compared with HEAD, so give the commit rather than the tag
+        return read_ref(common_dir, ref, packed_refs, peel=True)
+
+    try:
+        with open(stamp(os.path.join(git_dir, 'HEAD'))) as head_file:
+            head = head_file.read().strip()
+    except IOError:
+        head = ''
+    branch, head_sha = None, None
+    if head.startswith('ref: '):
+        head_ref = head[len('ref: '):]
+        if head_ref.startswith('refs/heads/'):
+            branch = head_ref[len('refs/heads/'):]
+        head_sha = resolve(head_ref)
+    elif head:
+        head_sha = head
+
+    moved = last_reflog_time(stamp(os.path.join(git_dir, 'logs', 'HEAD')))
+    if moved is None and branch:
+        # No reflog: fall back to when the branch was last written
+        branch_mtime = stamps[os.path.join(common_dir, 'refs', 'heads',
+                                           *branch.split('/'))]
+        moved = branch_mtime / 1e9 if branch_mtime is not None else None
+
+    ref_shas = {}
+    for ref in refs:
+        candidates = [ref] if ref.startswith('refs/') else [
+            candidate.format(ref) for candidate in REF_CANDIDATES
+        ]
+        ref_shas[ref] = None
+        for candidate in candidates:
+            sha = resolve(candidate)
+            if sha:
+                ref_shas[ref] = sha
+                break
+
+    return {
+        'branch': branch,
+        'head': head_sha,
+        'moved': moved,
+        'refs': ref_shas,
+        'stamps': stamps
+    }
+
+
+def has_moved(checkout_state, since):
+    """Whether a checkout has moved since ('time', timestamp) or is somewhere
+    other than ('ref', name). When that can't be told from the files, the
+    checkout counts as changed."""
+    kind, value = since
+    if kind == 'time':
+        return checkout_state['moved'] is None or checkout_state['moved'] >= value
+    target = value if SHA.match(value) else checkout_state['refs'].get(value)
+    return not target or checkout_state['head'] != target
+
+
+def on_branch(checkout_state, pattern):
+    return bool(checkout_state['branch']) and fnmatch.fnmatchcase(
+        checkout_state['branch'], pattern
+    )
+
+
+class RefState(JsonFile):
+    """Remembers what read_checkout found in each checkout until the HEAD,
+    reflog or ref files it read from change."""
+
+    def read(self, checkout, refs=()):
+        git_dir = find_git_dir(checkout)
+        if not git_dir:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(checkout)
+        if entry and all(ref in entry['refs'] for ref in refs) and all(
+                mtime(location) == stamp
+                for location, stamp in entry['stamps'].items()):
+            return entry
+
+        # Keep the refs asked for before, so alternating between them doesn't
+        # keep throwing the entry away
+        known = list(entry['refs']) if entry else []
+        entry = read_checkout(git_dir, known + [ref for ref in refs
+                                                if ref not in known])
+        with self.lock:
+            self.entries[checkout] = entry
+            self.mark_changed(checkout)
+        return entry
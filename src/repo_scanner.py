@@ -0,0 +1,113 @@
+import os
+import re
+
+from json_file import JsonFile
+
+BITBUCKET_URL = re.compile(
+    r'^(?:git@bitbucket\.org:|ssh://git@bitbucket\.org/|https?://(?:[^@/]+@)?bitbucket\.org/)'
+    r'(?P<full_name>[^/]+/[^/]+?)(?:\.git)?/?$'
+)
+REMOTE_SECTION = re.compile(r'^\s*\[\s*remote\s+"(?P<name>[^"]*)"\s*\]')
+URL_SETTING = re.compile(r'^\s*url\s*=\s*(?P<url>.*?)\s*$')
+
+
+def bitbucket_full_name(url):
+    match = BITBUCKET_URL.match(url or '')
+    return match.group('full_name') if match else None
+
+
+def find_git_dir(checkout):
+    dot_git = os.path.join(checkout, '.git')
+    if os.path.isdir(dot_git):
+        return dot_git
+    try:
+        with open(dot_git) as dot_git_file:
+            contents = dot_git_file.read().strip()
+    except IOError:
+        return None
+
+    # Worktrees and submodules have a .git file pointing at the real git dir
+    if not contents.startswith('gitdir:'):
+        return None
+    return os.path.normpath(os.path.join(checkout, contents[len('gitdir:'):].strip()))
+
+
+def find_common_dir(git_dir):
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as commondir_file:
+            return os.path.normpath(
+                os.path.join(git_dir, commondir_file.read().strip())
+            )
+    except IOError:
+        return git_dir
+
+
+def find_config(git_dir):
+    return os.path.join(find_common_dir(git_dir), 'config')
+
+
+def read_origin_url(config_location):
+    in_origin = False
+    with open(config_location) as config_file:
+        for line in config_file:
+            if line.lstrip().startswith('['):
+                section = REMOTE_SECTION.match(line)
+                in_origin = bool(section) and section.group('name') == 'origin'
+            elif in_origin:
+                setting = URL_SETTING.match(line)
+                if setting:
+                    return setting.group('url')
+    return None
+
+
+class RepoScanner(JsonFile):
+    """Finds the origin of local checkouts by reading their git config
+    directly, remembering each answer until the config file changes."""
+
+    def origin_url(self, checkout):
+        git_dir = find_git_dir(checkout)
+        if not git_dir:
+            return None
+        config_location = find_config(git_dir)
+        try:
+            mtime = os.stat(config_location).st_mtime_ns
+        except OSError:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(config_location)
+        if entry and entry['mtime'] == mtime:
+            return entry['url']
+
+        try:
+            url = read_origin_url(config_location)
+        except IOError:
+            return None
+        with self.lock:
+            self.entries[config_location] = {'mtime': mtime, 'url': url}
+            self.mark_changed(config_location)
+        return url
+
+    def find_checkouts(self, repos, path):
+        """Return the subset of repos that are checked out directly under path."""
+        return set(
+            repo for repo in repos
+            if bitbucket_full_name(
+                self.origin_url(os.path.join(path, repo.split('/')[-1]))
+            ) == repo
+        )
+
+    def scan(self, root):
+        """Yield (full_name, location) for every bitbucket checkout under root."""
+        for directory, subdirectories, files in os.walk(root):
+            if '.git' in subdirectories or '.git' in files:
+                # Don't look for nested repos inside a checkout
+                subdirectories[:] = []
+                full_name = bitbucket_full_name(self.origin_url(directory))
+                if full_name:
+                    yield full_name, directory
+                continue
+            subdirectories[:] = sorted(
+                subdirectory for subdirectory in subdirectories
+                if not subdirectory.startswith('.')
+            )
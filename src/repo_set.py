@@ -0,0 +1,108 @@
+import sys
+import threading
+
+
+class RepoSetResolver:
+    """Expands comma-separated repo specs into an ordered, duplicate-free list.
+
+    Each term is one of:
+      name            a single repo
+      /group          every repo in a stored group
+      @user/team/proj every repo bitbucket lists for a user, team or project,
+                      optionally narrowed by filters such as
+                      @/team:name~api:language=python:since=2024-01-01
+
+    and can be prefixed with '-' to remove its repos from the set built so far,
+    or '&' to keep only the repos that are also in it. Terms are applied left to
+    right, and each distinct term is only expanded once.
+
+    iter_resolve yields repos as they are found: '-' and '&' terms are expanded
+    up front, and everything else is streamed through them.
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, specs):
+        return list(self.iter_resolve(specs))
+
+    def iter_resolve(self, specs):
+        terms = [term for term in specs.split(',') if term]
+        modifiers = [
+            (position, term[0], set(self.iter_expand(term[1:])))
+            for position, term in enumerate(terms)
+            if term.startswith(('-', '&'))
+        ]
+
+        seen = set()
+        for position, term in enumerate(terms):
+            if term.startswith(('-', '&')):
+                continue
+            # A repo is only in the result if every later '-' and '&' term
+            # would have let it through
+            later = [
+                (kind, repos)
+                for modifier_position, kind, repos in modifiers
+                if modifier_position > position
+            ]
+            for repo in self.iter_expand(term):
+                if repo in seen:
+                    continue
+                if all((repo in repos) == (kind == '&') for kind, repos in later):
+                    seen.add(repo)
+                    yield repo
+
+    def iter_expand(self, term):
+        if term in self.memo:
+            self.hits += 1
+            yield from self.memo[term]
+            return
+
+        self.misses += 1
+        repos = []
+        try:
+            expanded = self._expand(term)
+            if expanded is None:
+                return
+            for repo in expanded:
+                repos.append(repo)
+                yield repo
+        except ValueError as e:
+            sys.stderr.write('Cannot parse repo "{}": {}\n'.format(term, e))
+            return
+        self.memo[term] = repos
+
+    def add_counts(self, other):
+        """Fold another resolver's hit and miss counts into this one's."""
+        with self.lock:
+            self.hits += other.hits
+            self.misses += other.misses
+
+    def _expand(self, term):
+        if term.startswith('/'):
+            return list(self.controller.list_repository_group(term[1:]))
+        if not term.startswith('@'):
+            return [term]
+
+        path, *filters = term[1:].split(':')
+        repo_params = path.split('/')
+        user = repo_params[0]
+        if not user:
+            user = self.controller.default_user()
+        if not user:
+            sys.stderr.write('Cannot parse repo "{}"\n'.format(term))
+            return None
+
+        if len(repo_params) == 1:
+            return self.controller.get_repos_for_user(user, filters)
+        elif len(repo_params) == 2:
+            return self.controller.get_repos_for_team(
+                user, repo_params[1], filters
+            )
+        return self.controller.get_repos_for_project(
+            user, repo_params[1], repo_params[2], filters
+        )
@@ -0,0 +1,64 @@
+import time
+
+from executor import run_command
+
+
+def parse_porcelain_v2(output):
+    status = {
+        'branch': None,
+        'upstream': None,
+        'ahead': 0,
+        'behind': 0,
+        'changed': 0,
+        'untracked': 0
+    }
+    for line in output.splitlines():
+        if line.startswith('# branch.head '):
+            head = line[len('# branch.head '):]
+            status['branch'] = None if head == '(detached)' else head
+        elif line.startswith('# branch.upstream '):
+            status['upstream'] = line[len('# branch.upstream '):]
+        elif line.startswith('# branch.ab '):
+            ahead, behind = line[len('# branch.ab '):].split()
+            status['ahead'] = int(ahead)
+            status['behind'] = -int(behind)
+        elif line.startswith(('1 ', '2 ', 'u ')):
+            status['changed'] += 1
+        elif line.startswith('? '):
+            status['untracked'] += 1
+    status['dirty'] = bool(status['changed'] or status['untracked'])
+    return status
+
+
+def collect_status(checkout, timeout=None):
+    output, error, code = run_command(
+        ['git', 'status', '--porcelain=v2', '--branch'], checkout, timeout
+    )
+    if code != 0:
+        return {'error': error.strip()}
+    status = parse_porcelain_v2(output)
+
+    output, error, code = run_command(
+        ['git', 'log', '-1', '--format=%ct'], checkout, timeout
+    )
+    status['last_commit'] = int(output.strip()) if code == 0 and output.strip() else None
+    return status
+
+
+def is_dirty(checkout, timeout=None):
+    """Whether checkout has uncommitted or untracked changes. A checkout git
+    can't report on counts as dirty."""
+    output, error, code = run_command(
+        ['git', 'status', '--porcelain=v2'], checkout, timeout
+    )
+    return code != 0 or parse_porcelain_v2(output)['dirty']
+
+
+def format_age(timestamp, now=None):
+    if timestamp is None:
+        return '-'
+    seconds = max(0, (now or time.time()) - timestamp)
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return '{}{}'.format(int(seconds // size), unit)
+    return '{}s'.format(int(seconds))
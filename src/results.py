@@ -0,0 +1,162 @@
+import json
+import shlex
+import sys
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values, e.g. fraction=0.95 for p95."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(-(-fraction * len(ordered) // 1)))
+    return ordered[rank - 1]
+
+
+def failed(record):
+    return record.get('exit_code') != 0
+
+
+class ResultWriter:
+    """Collects the per-repo records of a `do` run, printing them as they
+    arrive, and prints a summary at the end."""
+
+    def __init__(self):
+        self.total = 0
+        self.failed = 0
+        self.skipped = 0
+        self.durations = []
+
+    def write(self, record):
+        self.total += 1
+        if failed(record):
+            self.failed += 1
+        if record.get('seconds') is not None:
+            self.durations.append(record['seconds'])
+        self.emit(record)
+
+    def skip(self, record):
+        """Note a repo that was left out by a filter, without a result."""
+        self.skipped += 1
+        self.emit_skip(record)
+
+    def summary(self):
+        return {
+            'type': 'summary',
+            'repos': self.total,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'seconds': {
+                'p50': percentile(self.durations, 0.5),
+                'p95': percentile(self.durations, 0.95),
+                'max': max(self.durations) if self.durations else None
+            }
+        }
+
+    def close(self):
+        self.finish(self.summary())
+        return min(self.failed, 125)
+
+    def emit(self, record):
+        pass
+
+    def emit_skip(self, record):
+        pass
+
+    def finish(self, summary):
+        pass
+
+
+class TextWriter(ResultWriter):
+    def __init__(self, quiet, clean, streamed, logged):
+        super().__init__()
+        self.quiet = quiet
+        self.clean = clean
+        self.streamed = streamed
+        self.logged = logged
+
+    def emit(self, record):
+        if record.get('error') == 'not installed':
+            print('{} is not installed{}'.format(
+                record['repo'],
+                ' at {}'.format(record['location']) if 'location' in record else ''
+            ))
+            return
+        if self.quiet:
+            return
+        if record.get('steps') and failed(record):
+            step = record['steps'][-1]
+            sys.stderr.write('{}: stopped at step {}, `{}` exited {}\n'.format(
+                record['repo'], len(record['steps']),
+                shlex.join(step['command']),
+                step['exit_code'] if step['exit_code'] is not None else 'abnormally'
+            ))
+        if self.streamed:
+            return
+
+        if self.logged:
+            print('{}: exited {}, output in {}'.format(
+                record['repo'], record['exit_code'], record['log']
+            ))
+            return
+
+        output = record['stdout'] + record['stderr']
+        if output:
+            if self.clean:
+                sys.stdout.write(output)
+            else:
+                print('{}:'.format(record['repo']))
+                print(output)
+
+    def finish(self, summary):
+        if self.failed:
+            sys.stderr.write('{} of {} repos failed\n'.format(
+                self.failed, self.total
+            ))
+        if self.skipped:
+            sys.stderr.write("{} repos didn't match the filters\n".format(
+                self.skipped
+            ))
+
+
+class NdjsonWriter(ResultWriter):
+    def emit(self, record):
+        print(json.dumps(dict(record, type='result'), sort_keys=True))
+        sys.stdout.flush()
+
+    def emit_skip(self, record):
+        # Lets whoever sharded the run tell a filtered repo from a lost one
+        print(json.dumps(dict(record, type='skipped'), sort_keys=True))
+        sys.stdout.flush()
+
+    def finish(self, summary):
+        print(json.dumps(summary, sort_keys=True))
+
+
+class JsonWriter(ResultWriter):
+    """Writes one JSON document, but streams each result into it as it
+    arrives rather than building the whole document in memory."""
+
+    def __init__(self):
+        super().__init__()
+        self.separator = '\n  '
+        sys.stdout.write('{"results": [')
+
+    def emit(self, record):
+        sys.stdout.write(self.separator + json.dumps(record, sort_keys=True))
+        sys.stdout.flush()
+        self.separator = ',\n  '
+
+    def finish(self, summary):
+        summary.pop('type')
+        sys.stdout.write('\n], "summary": {}}}\n'.format(
+            json.dumps(summary, sort_keys=True)
+        ))
+
+
+def make_writer(output_format, quiet=False, clean=False, streamed=False,
+                logged=False):
+    if output_format == 'json':
+        return JsonWriter()
+    if output_format == 'ndjson':
+        return NdjsonWriter()
+    return TextWriter(quiet, clean, streamed, logged)
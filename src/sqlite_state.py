@@ -0,0 +1,277 @@
+import contextlib
+import itertools
+import json
+import sqlite3
+import threading
+
+import metrics
+
+MAX_QUERY_PARAMS = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    auth_secret TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS groups (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS group_repos (
+    group_name TEXT NOT NULL REFERENCES groups(name) ON DELETE CASCADE,
+    repo TEXT NOT NULL,
+    PRIMARY KEY (group_name, repo)
+);
+CREATE INDEX IF NOT EXISTS group_repos_repo ON group_repos(repo);
+CREATE TABLE IF NOT EXISTS repo_paths (
+    repo TEXT PRIMARY KEY,
+    path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS repo_locations (
+    path TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    PRIMARY KEY (path, repo)
+);
+CREATE INDEX IF NOT EXISTS repo_locations_repo ON repo_locations(repo);
+'''
+
+
+class SqliteState:
+    """The same interface as state.State, backed by a SQLite database in WAL
+    mode so that concurrent git-all processes only ever write the rows they
+    change, each inside its own transaction."""
+
+    def __init__(self, file_location):
+        self.file_location = file_location
+        self.lock = threading.RLock()
+        with metrics.span('state_load', backend='sqlite'):
+            self.connection = sqlite3.connect(file_location,
+                                              timeout=30,
+                                              isolation_level=None,
+                                              check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA foreign_keys=ON')
+            self.connection.executescript(SCHEMA)
+
+    def remove_user_credentials(self, user):
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM users WHERE name = ?', (user,))
+
+    def update_user_credentials(self, user, auth_secret):
+        with self._transaction() as cursor:
+            cursor.execute('INSERT OR REPLACE INTO users (name, auth_secret) '
+                           'VALUES (?, ?)', (user, auth_secret))
+
+    def get_user_credentials(self, user):
+        return self._value('SELECT auth_secret FROM users WHERE name = ?', user)
+
+    def list_users(self):
+        return self._column('SELECT name FROM users ORDER BY rowid')
+
+    def get_default_user(self):
+        return self._value('SELECT value FROM settings WHERE key = ?',
+                           'default_user')
+
+    def set_default_user(self, user):
+        with self._transaction() as cursor:
+            if user:
+                cursor.execute('INSERT OR REPLACE INTO settings (key, value) '
+                               'VALUES (?, ?)', ('default_user', user))
+            else:
+                cursor.execute('DELETE FROM settings WHERE key = ?',
+                               ('default_user',))
+
+    def list_groups(self):
+        return self._column('SELECT name FROM groups ORDER BY rowid')
+
+    def remove_repository_group(self, group_name):
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM groups WHERE name = ?', (group_name,))
+
+    def add_to_repository_group(self, group_name, new_repos):
+        with self._transaction() as cursor:
+            cursor.execute('INSERT OR IGNORE INTO groups (name) VALUES (?)',
+                           (group_name,))
+        # new_repos may be a slow stream from bitbucket, so commit as it goes
+        # rather than holding the write lock until it ends
+        new_repos = iter(new_repos)
+        while True:
+            batch = list(itertools.islice(new_repos, MAX_QUERY_PARAMS))
+            if not batch:
+                break
+            with self._transaction() as cursor:
+                cursor.executemany('INSERT OR IGNORE INTO group_repos '
+                                   '(group_name, repo) VALUES (?, ?)',
+                                   ((group_name, repo) for repo in batch))
+
+    def get_repository_group(self, group_name):
+        return self._column('SELECT repo FROM group_repos WHERE group_name = ? '
+                            'ORDER BY rowid', group_name)
+
+    def set_repo_path(self, repo, path):
+        with self._transaction() as cursor:
+            cursor.execute('INSERT OR REPLACE INTO repo_paths (repo, path) '
+                           'VALUES (?, ?)', (repo, path))
+
+    def add_repo_location(self, path, repo):
+        with self._transaction() as cursor:
+            cursor.execute('INSERT OR IGNORE INTO repo_locations (path, repo) '
+                           'VALUES (?, ?)', (path, repo))
+
+    def remove_repo_location(self, path, repo):
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM repo_locations WHERE path = ? AND repo = ?',
+                           (path, repo))
+            cursor.execute('SELECT path FROM repo_paths WHERE repo = ?', (repo,))
+            row = cursor.fetchone()
+            if not row or row[0] != path:
+                return
+            # The primary checkout went away; fall back to the newest other one
+            cursor.execute('SELECT path FROM repo_locations WHERE repo = ? '
+                           'ORDER BY rowid DESC LIMIT 1', (repo,))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute('UPDATE repo_paths SET path = ? WHERE repo = ?',
+                               (row[0], repo))
+            else:
+                cursor.execute('DELETE FROM repo_paths WHERE repo = ?', (repo,))
+
+    def get_repo_path(self, repo):
+        return self._value('SELECT path FROM repo_paths WHERE repo = ?', repo)
+
+    def get_repo_paths(self, repos, location=None):
+        if location is None:
+            query = 'SELECT repo, path FROM repo_paths WHERE repo IN ({})'
+            params = ()
+        else:
+            query = ('SELECT repo, path FROM repo_locations '
+                     'WHERE path = ? AND repo IN ({})')
+            params = (location,)
+
+        repos = list(repos)
+        repo_paths = {}
+        with self.lock:
+            for start in range(0, len(repos), MAX_QUERY_PARAMS):
+                chunk = repos[start:start + MAX_QUERY_PARAMS]
+                repo_paths.update(self.connection.execute(
+                    query.format(','.join('?' * len(chunk))),
+                    params + tuple(chunk)
+                ))
+        return repo_paths
+
+    def list_repo_paths(self):
+        with self.lock:
+            return dict(self.connection.execute(
+                'SELECT repo, path FROM repo_paths ORDER BY repo'
+            ))
+
+    def list_repo_registrations(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT repo, path FROM repo_locations UNION '
+                'SELECT repo, path FROM repo_paths ORDER BY repo, path'
+            ).fetchall()
+
+    def list_repo_locations(self):
+        return self._column('SELECT DISTINCT path FROM repo_locations')
+
+    def get_repos_for_repo_location(self, path):
+        return self._column('SELECT repo FROM repo_locations WHERE path = ? '
+                            'ORDER BY rowid', path)
+
+    def migrate_from_json(self, json_location):
+        """Import a credentials.conf written by state.State, once."""
+        # Checked without a write lock first, as this runs on every start
+        if self._value('SELECT value FROM settings WHERE key = ?',
+                       'migrated_from'):
+            return False
+        try:
+            with open(json_location) as json_file:
+                old_state = json.load(json_file)
+        except (IOError, ValueError):
+            return False
+
+        with self._transaction() as cursor:
+            # Another process may have imported it in the meantime
+            cursor.execute('SELECT value FROM settings WHERE key = ?',
+                           ('migrated_from',))
+            if cursor.fetchone():
+                return False
+
+            cursor.executemany(
+                'INSERT OR REPLACE INTO users (name, auth_secret) VALUES (?, ?)',
+                old_state.get('user', {}).items()
+            )
+            default_user = old_state.get('default', {}).get('user')
+            if default_user:
+                cursor.execute('INSERT OR REPLACE INTO settings (key, value) '
+                               'VALUES (?, ?)', ('default_user', default_user))
+            for group_name, repos in old_state.get('group', {}).items():
+                cursor.execute('INSERT OR IGNORE INTO groups (name) VALUES (?)',
+                               (group_name,))
+                cursor.executemany('INSERT OR IGNORE INTO group_repos '
+                                   '(group_name, repo) VALUES (?, ?)',
+                                   ((group_name, repo) for repo in repos))
+            cursor.executemany(
+                'INSERT OR REPLACE INTO repo_paths (repo, path) VALUES (?, ?)',
+                ((repo, info['path'])
+                 for repo, info in old_state.get('repo', {}).items()
+                 if info.get('path'))
+            )
+            cursor.executemany(
+                'INSERT OR IGNORE INTO repo_locations (path, repo) VALUES (?, ?)',
+                ((path, repo)
+                 for path, info in old_state.get('repo_locations', {}).items()
+                 for repo in info.get('repos', []))
+            )
+            cursor.execute('INSERT INTO settings (key, value) VALUES (?, ?)',
+                           ('migrated_from', json_location))
+        return True
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock, metrics.span('state_save', backend='sqlite'):
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+    def _value(self, query, *params):
+        with self.lock:
+            row = self.connection.execute(query, params).fetchone()
+        return row[0] if row else None
+
+    def _column(self, query, *params):
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [row[0] for row in rows]
+
+    def commit(self):
+        # Every mutation is already committed in its own transaction
+        pass
+
+    def reload_if_changed(self):
+        # Every read already sees other processes' committed writes
+        pass
+
+    def close(self):
+        # The connection is missing if opening the database failed
+        connection = getattr(self, 'connection', None)
+        if connection:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.commit()
+
+    def __del__(self):
+        self.close()
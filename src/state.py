@@ -1,85 +1,282 @@
 import json
 import os
+import tempfile
+import threading
+
+import metrics
+import sqlite_state
 
 class State:
+    """Users, groups and registered repos kept in one JSON file.
+
+    Every method holds the lock while it touches the loaded state, so that
+    commands running at once in the daemon can share one State.
+    """
+
     def __init__(self, file_location):
+        self.lock = threading.RLock()
         self.file_location = file_location
+        self.loaded_mtime = self._mtime()
         self.state = self._retrieve_state()
+        self.dirty = False
+        self.locations_by_repo = None
+        self.group_members = {}
 
     def remove_user_credentials(self, user):
-        self.ensure('user').pop(user, None)
+        with self.lock:
+            if user in self.lookup('user'):
+                self.ensure('user').pop(user)
+                self.dirty = True
 
     def update_user_credentials(self, user, auth_secret):
-        self.ensure('user')[user] = auth_secret
+        self.set_value(('user',), user, auth_secret)
 
     def get_user_credentials(self, user):
-        return self.ensure('user').get(user)
+        with self.lock:
+            return self.lookup('user').get(user)
 
     def list_users(self):
-        return self.ensure('user').keys()
+        with self.lock:
+            return list(self.lookup('user'))
 
     def get_default_user(self):
-        return self.ensure('default').get('user')
+        with self.lock:
+            return self.lookup('default').get('user')
 
     def set_default_user(self, user):
-        if user:
-            self.ensure('default')['user'] = user
-        else:
-            self.ensure('default').pop('user', None)
+        with self.lock:
+            if user:
+                self.set_value(('default',), 'user', user)
+            elif 'user' in self.lookup('default'):
+                self.ensure('default').pop('user')
+                self.dirty = True
 
     def list_groups(self):
-        return self.ensure('group').keys()
-            
+        with self.lock:
+            return list(self.lookup('group'))
+
     def remove_repository_group(self, group_name):
-        self.ensure('group').pop(group_name, None)
+        with self.lock:
+            self.group_members.pop(group_name, None)
+            if group_name in self.lookup('group'):
+                self.ensure('group').pop(group_name)
+                self.dirty = True
 
     def add_to_repository_group(self, group_name, new_repos):
-        existing_repos = self.get_repository_group(group_name)
-        self.ensure('group')[group_name] = list(set(new_repos) | set(existing_repos))
-        
+        with self.lock:
+            groups = self.ensure('group')
+            if group_name not in groups:
+                groups[group_name] = []
+                self.dirty = True
+
+        # new_repos may be streaming in from bitbucket, so only hold the lock
+        # while adding each one
+        for repo in new_repos:
+            with self.lock:
+                repos = self.ensure('group').setdefault(group_name, [])
+                if group_name not in self.group_members:
+                    self.group_members[group_name] = set(repos)
+                members = self.group_members[group_name]
+                if repo not in members:
+                    members.add(repo)
+                    repos.append(repo)
+                    self.dirty = True
+
     def get_repository_group(self, group_name):
-        return self.ensure('group').get(group_name, [])
+        with self.lock:
+            return list(self.lookup('group').get(group_name, []))
 
     def set_repo_path(self, repo, path):
-        self.ensure('repo', repo)['path'] = path
+        self.set_value(('repo', repo), 'path', path)
 
     def add_repo_location(self, path, repo):
-        path_repos = self.ensure('repo_locations', path).get('repos', [])
-        path_repos.append(repo)
-        self.ensure('repo_locations', path)['repos'] = path_repos
+        with self.lock:
+            paths = self._locations_by_repo().setdefault(repo, [])
+            if path in paths:
+                return
+            paths.append(path)
+            self.ensure('repo_locations', path).setdefault('repos', []).append(repo)
+            self.dirty = True
+
+    def remove_repo_location(self, path, repo):
+        with self.lock:
+            paths = self._locations_by_repo().get(repo, [])
+            if path in paths:
+                paths.remove(path)
+
+            path_repos = self.lookup('repo_locations', path).get('repos', [])
+            if repo in path_repos:
+                remaining = [other for other in path_repos if other != repo]
+                if remaining:
+                    self.set_value(('repo_locations', path), 'repos', remaining)
+                else:
+                    self.ensure('repo_locations').pop(path)
+                    self.dirty = True
+
+            if self.get_repo_path(repo) == path:
+                if paths:
+                    self.set_repo_path(repo, paths[-1])
+                else:
+                    self.ensure('repo').pop(repo)
+                    self.dirty = True
 
     def get_repo_path(self, repo):
-        return self.ensure('repo', repo).get('path');
-        
+        with self.lock:
+            return self.lookup('repo', repo).get('path')
+
+    def get_repo_paths(self, repos, location=None):
+        with self.lock:
+            if location is not None:
+                locations_by_repo = self._locations_by_repo()
+                return {
+                    repo: location
+                    for repo in repos
+                    if location in locations_by_repo.get(repo, ())
+                }
+
+            repo_info = self.lookup('repo')
+            return {
+                repo: repo_info[repo].get('path')
+                for repo in repos
+                if repo in repo_info
+            }
+
+    def list_repo_paths(self):
+        with self.lock:
+            return {
+                repo: info['path']
+                for repo, info in self.lookup('repo').items()
+                if info.get('path')
+            }
+
+    def list_repo_registrations(self):
+        with self.lock:
+            registrations = set(self.list_repo_paths().items())
+            for repo, paths in self._locations_by_repo().items():
+                registrations.update((repo, path) for path in paths)
+        return sorted(registrations)
+
     def list_repo_locations(self):
-        return self.ensure('repo_locations').keys()
+        with self.lock:
+            return list(self.lookup('repo_locations'))
 
     def get_repos_for_repo_location(self, path):
-        return self.ensure('repo_locations', path).get('repos', [])
-        
+        # Older versions could record a repo at the same path more than once
+        with self.lock:
+            return list(dict.fromkeys(
+                self.lookup('repo_locations', path).get('repos', [])
+            ))
+
+    def _locations_by_repo(self):
+        """The reverse of repo_locations, built the first time it's needed."""
+        if self.locations_by_repo is None:
+            locations_by_repo = {}
+            for path, info in self.lookup('repo_locations').items():
+                for repo in info.get('repos', []):
+                    paths = locations_by_repo.setdefault(repo, [])
+                    if path not in paths:
+                        paths.append(path)
+            self.locations_by_repo = locations_by_repo
+        return self.locations_by_repo
+
+    def lookup(self, *path):
+        """Like ensure, but for reading: missing components are not created."""
+        cur_dict = self.state
+        for path_component in path:
+            if path_component not in cur_dict:
+                return {}
+            cur_dict = cur_dict[path_component]
+        return cur_dict
+
     def ensure(self, *path):
         cur_dict = self.state
         for path_component in path:
             if path_component not in cur_dict:
                 cur_dict[path_component] = {}
-            cur_dict = cur_dict[path_component]                
+                self.dirty = True
+            cur_dict = cur_dict[path_component]
         return cur_dict
 
-    def _retrieve_state(self):
+    def set_value(self, path, key, value):
+        with self.lock:
+            container = self.ensure(*path)
+            if container.get(key) != value:
+                container[key] = value
+                self.dirty = True
+
+    def commit(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self._save()
+            self.loaded_mtime = self._mtime()
+            self.dirty = False
+
+    def reload_if_changed(self):
+        """Pick up writes from other processes, for long-lived States."""
+        with self.lock:
+            if not self.dirty and self._mtime() != self.loaded_mtime:
+                self.loaded_mtime = self._mtime()
+                self.state = self._retrieve_state()
+                self.locations_by_repo = None
+                self.group_members = {}
+
+    def _mtime(self):
         try:
-            state = json.load(open(self.file_location))
-        except IOError:
-            state = {}
+            return os.stat(self.file_location).st_mtime_ns
+        except OSError:
+            return None
+
+    def _retrieve_state(self):
+        with metrics.span('state_load', backend='json'):
+            try:
+                with open(self.file_location) as state_file:
+                    state = json.load(state_file)
+            except IOError:
+                state = {}
         return state
 
     def _save(self):
-        json.dump(self.state, open(self.file_location, 'w'))
+        # Write a sibling file and rename it over the old one, so a crash
+        # mid-write leaves the previous state intact rather than a torn file
+        directory = os.path.dirname(self.file_location) or '.'
+        with metrics.span('state_save', backend='json'):
+            fd, temp_location = tempfile.mkstemp(dir=directory,
+                                                 prefix='.credentials.')
+            try:
+                with os.fdopen(fd, 'w') as state_file:
+                    json.dump(self.state, state_file)
+                    state_file.flush()
+                    os.fsync(state_file.fileno())
+                os.replace(temp_location, self.file_location)
+            except BaseException:
+                os.unlink(temp_location)
+                raise
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
-        self._save()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.commit()
+
+
+def conf_path(file_name):
+    conf_dir = os.environ.get('GIT_ALL_CONF_DIR')
+    if not conf_dir:
+        file_path = os.path.abspath(__file__)
+        project_path = os.path.dirname(os.path.dirname(file_path))
+        conf_dir = '{}/conf'.format(project_path)
+    return '{}/{}'.format(conf_dir, file_name)
 
 
 def get_state():
-    file_path = os.path.abspath(__file__)
-    project_path = os.path.dirname(os.path.dirname(file_path))
-    return State('{}/conf/credentials.conf'.format(project_path))
+    json_location = conf_path('credentials.conf')
+    # A fresh install, or a GIT_ALL_CONF_DIR that doesn't exist yet
+    os.makedirs(os.path.dirname(json_location), exist_ok=True)
+    if os.environ.get('GIT_ALL_STATE_BACKEND', 'sqlite') == 'json':
+        return State(json_location)
+
+    state = sqlite_state.SqliteState(conf_path('state.db'))
+    if os.path.exists(json_location):
+        state.migrate_from_json(json_location)
+    return state
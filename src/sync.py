@@ -0,0 +1,95 @@
+import time
+
+from executor import run_command
+from git_refs import read_head, read_packed_refs, read_ref, read_refs
+from json_file import JsonFile
+from repo_scanner import find_common_dir, find_git_dir
+
+
+def parse_ls_remote(output):
+    refs = {}
+    for line in output.splitlines():
+        parts = line.split('\t')
+        if len(parts) == 2 and not parts[1].endswith('^{}'):
+            refs[parts[1]] = parts[0]
+    return refs
+
+
+def tracking_refs(checkout):
+    """The remote's branches as this checkout last fetched them."""
+    return {
+        'refs/heads/' + ref[len('refs/remotes/origin/'):]: sha
+        for ref, sha in read_refs(checkout, 'refs/remotes/origin/').items()
+        if not ref.endswith('/HEAD')
+    }
+
+
+def branch_position(checkout):
+    """Return (local sha, origin's sha) for the checked-out branch, or None
+    if HEAD is detached or origin has no such branch."""
+    branch = read_head(checkout)
+    if not branch:
+        return None
+    common_dir = find_common_dir(find_git_dir(checkout))
+    packed_refs = read_packed_refs(common_dir)
+    upstream = read_ref(common_dir, 'refs/remotes/origin/' + branch, packed_refs)
+    if upstream is None:
+        return None
+    return read_ref(common_dir, 'refs/heads/' + branch, packed_refs), upstream
+
+
+def sync_checkout(checkout, last_seen, fast_forward=True, timeout=None):
+    """Fetch (and optionally fast-forward) checkout, but only if the branches
+    on origin have moved since last_seen or since the last fetch, or the
+    checked-out branch hasn't caught up with what was fetched."""
+    output, error, status = run_command(
+        ['git', 'ls-remote', '--heads', 'origin'], checkout, timeout
+    )
+    if status != 0:
+        return {'status': 'failed', 'error': error}
+
+    remote = parse_ls_remote(output)
+    fetched = remote == last_seen or (not last_seen and
+                                      remote == tracking_refs(checkout))
+    if not fetched:
+        output, error, status = run_command(
+            ['git', 'fetch', '--prune', '--quiet', 'origin'], checkout, timeout
+        )
+        if status != 0:
+            return {'status': 'failed', 'error': error}
+
+    position = branch_position(checkout) if fast_forward else None
+    if position is None or position[0] == position[1]:
+        return {'status': 'fetched' if not fetched else 'unchanged',
+                'refs': remote}
+
+    output, error, status = run_command(
+        ['git', 'merge', '--ff-only', '--quiet', '@{u}'], checkout, timeout
+    )
+    if status != 0:
+        return {'status': 'fetched', 'refs': remote,
+                'error': 'not fast-forwarded: {}'.format(error.strip())}
+    if branch_position(checkout) == position:
+        # Local commits on top of origin's: nothing to fast-forward
+        return {'status': 'fetched' if not fetched else 'unchanged',
+                'refs': remote}
+    return {'status': 'updated', 'refs': remote}
+
+
+class SyncState(JsonFile):
+    """Per-repo record of the remote branches seen at the last sync."""
+
+    def last_seen(self, repo):
+        return self.entries.get(repo, {}).get('refs')
+
+    def record(self, repo, result):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.setdefault(repo, {})
+            entry['checked'] = now
+            entry['status'] = result['status']
+            if result['status'] != 'failed':
+                entry['refs'] = result['refs']
+            if result['status'] in ('fetched', 'updated'):
+                entry['fetched'] = now
+            self.mark_changed(repo)
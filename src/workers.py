@@ -0,0 +1,200 @@
+"""Runs `git-all do` across several worker hosts.
+
+The repo set is split into one shard per worker. Each worker runs
+`git-all do --format ndjson` on its own checkouts, and the per-repo records it
+prints are passed back as they arrive. Repos a worker doesn't report (because
+it failed, or doesn't have them installed) are retried on another worker.
+"""
+import json
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+
+from executor import environ, finish_process, in_context, start_process
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+REMOTE_COMMAND = os.environ.get('GIT_ALL_REMOTE_COMMAND', 'git-all')
+
+
+class LocalTransport:
+    """Runs shards with this git-all in a subprocess on this machine. Give a
+    configuration directory (local:DIR) to stand in for another host's
+    registry when trying out sharded runs."""
+
+    def __init__(self, conf_dir=None):
+        self.name = 'local:{}'.format(conf_dir) if conf_dir else 'local'
+        self.conf_dir = conf_dir
+
+    def command(self, argv):
+        return [sys.executable, os.path.join(SRC_DIR, '__main__.py')] + argv
+
+    def env(self):
+        # Shards may read their script from stdin, which a daemon can't see
+        env = dict(environ(), GIT_ALL_NO_DAEMON='1')
+        if self.conf_dir:
+            env['GIT_ALL_CONF_DIR'] = self.conf_dir
+        return env
+
+
+class SshTransport:
+    """Runs shards with the git-all installed on another host, over ssh."""
+
+    def __init__(self, host):
+        if not host:
+            raise ValueError('ssh workers need a host name')
+        self.name = host
+        self.host = host
+
+    def command(self, argv):
+        return ['ssh', '-o', 'BatchMode=yes', self.host,
+                shlex.join(['env', 'GIT_ALL_NO_DAEMON=1', REMOTE_COMMAND] + argv)]
+
+    def env(self):
+        return environ()
+
+
+TRANSPORTS = {
+    'local': LocalTransport,
+    'ssh': SshTransport
+}
+
+
+def make_transport(spec):
+    """Parse a worker like 'local', 'local:DIR', 'ssh:HOST' or a bare HOST."""
+    scheme, separator, target = spec.partition(':')
+    if separator and scheme in TRANSPORTS:
+        return TRANSPORTS[scheme](target or None)
+    if spec in TRANSPORTS:
+        return TRANSPORTS[spec]()
+    return SshTransport(spec)
+
+
+def run_shard(transport, argv, stdin_data, on_record):
+    """Run one shard, handing each per-repo record to on_record as soon as it
+    is printed. Returns the worker's exit status and stderr."""
+    process = start_process(transport.command(argv), None,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            env=transport.env())
+    errors = []
+    reader = threading.Thread(target=lambda: errors.append(process.stderr.read()))
+    reader.start()
+    try:
+        process.stdin.write((stdin_data or '').encode('utf-8'))
+        process.stdin.close()
+    except OSError:
+        pass
+
+    for line in process.stdout:
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            continue
+        kind = record.pop('type', None)
+        if kind in ('result', 'skipped'):
+            on_record(dict(record, skipped=True) if kind == 'skipped' else record)
+    status = process.wait()
+    finish_process(process)
+    reader.join()
+    return status, b''.join(errors).decode('utf-8', 'replace')
+
+
+def partition(repos, count):
+    """Deal repos out round-robin, so that if they are in order of expected
+    cost every shard gets a similar share of the slow ones."""
+    shards = [[] for _ in range(count)]
+    for index, repo in enumerate(repos):
+        shards[index % count].append(repo)
+    return shards
+
+
+def run_sharded(transports, repos, shard_argv, stdin_data=None):
+    """Run shard_argv(shard_repos) across transports, yielding each repo's
+    record (with the worker it ran on) as it arrives. Repos a worker filtered
+    out come back as records with 'skipped' set."""
+    results = queue.Queue()
+    tried = {repo: set() for repo in repos}
+    reported = set()
+    not_installed = {}
+    failed_workers = set()
+    running = 0
+
+    def run(index, shard_repos):
+        transport = transports[index]
+        try:
+            status, error = run_shard(
+                transport, shard_argv(shard_repos), stdin_data,
+                lambda record: results.put(('record', index, record))
+            )
+        except OSError as e:
+            status, error = None, str(e)
+        results.put(('done', index, (shard_repos, status, error)))
+
+    def start(index, shard_repos):
+        for repo in shard_repos:
+            tried[repo].add(index)
+        threading.Thread(target=in_context(run), args=(index, shard_repos),
+                         daemon=True).start()
+
+    for index, shard_repos in enumerate(partition(repos, len(transports))):
+        if shard_repos:
+            start(index, shard_repos)
+            running += 1
+
+    while running:
+        kind, index, payload = results.get()
+        if kind == 'record':
+            record = dict(payload, worker=transports[index].name)
+            if record.get('skipped'):
+                # Filtered out by --changed-since and the like where it ran
+                not_installed.pop(record['repo'], None)
+                if record['repo'] not in reported:
+                    reported.add(record['repo'])
+                    yield record
+            elif record.get('error') == 'not installed':
+                # Another worker may have it
+                not_installed[record['repo']] = record
+            elif record['repo'] not in reported:
+                reported.add(record['repo'])
+                yield record
+            continue
+
+        running -= 1
+        shard_repos, status, error = payload
+        leftover = [repo for repo in shard_repos if repo not in reported]
+        missing = [repo for repo in leftover if repo not in not_installed]
+        if missing:
+            failed_workers.add(index)
+            sys.stderr.write(
+                'Worker {} failed with {} repo(s) unreported (exit {}){}\n'.format(
+                    transports[index].name, len(missing), status,
+                    ':\n' + error.strip() if error.strip() else ''
+                )
+            )
+
+        retries = {}
+        for position, repo in enumerate(leftover):
+            untried = [
+                other for other in range(len(transports))
+                if other not in tried[repo] and other not in failed_workers
+            ]
+            if untried:
+                # Spread retries over the remaining workers
+                retry_index = untried[position % len(untried)]
+                retries.setdefault(retry_index, []).append(repo)
+                not_installed.pop(repo, None)
+            elif repo in not_installed:
+                reported.add(repo)
+                yield not_installed.pop(repo)
+            else:
+                reported.add(repo)
+                yield {'repo': repo, 'exit_code': None,
+                       'error': 'no worker could run it',
+                       'worker': transports[index].name}
+        for retry_index, retry_repos in sorted(retries.items()):
+            start(retry_index, retry_repos)
+            running += 1
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture(autouse=True)
+def conf_dir(tmp_path, monkeypatch):
+    """Keep every test's configuration out of the real conf/, and away from
+    any daemon that might be running."""
+    directory = tmp_path / 'conf'
+    directory.mkdir()
+    monkeypatch.setenv('GIT_ALL_CONF_DIR', str(directory))
+    monkeypatch.setenv('GIT_ALL_NO_DAEMON', '1')
+    monkeypatch.delenv('GIT_ALL_STATE_BACKEND', raising=False)
+    return directory
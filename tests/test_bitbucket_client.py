@@ -0,0 +1,84 @@
+import pytest
+
+import bitbucket_client
+import bitbucket_stub
+
+FIXTURE = {
+    'team': {
+        'API': ['api-{}'.format(index) for index in range(250)],
+        'WEB': ['web-{}'.format(index) for index in range(5)]
+    }
+}
+ALL_REPOS = sorted('team/{}'.format(repo)
+                   for repos in FIXTURE['team'].values() for repo in repos)
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    servers = []
+
+    def start(**faults):
+        server = bitbucket_stub.serve(FIXTURE, seed=1, **faults)
+        servers.append(server)
+        monkeypatch.setattr(bitbucket_client, 'API_URL', server.api_url)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = bitbucket_client.Scheduler(rate=1000, burst=1000, retries=5)
+    monkeypatch.setattr(bitbucket_client, 'scheduler', scheduler)
+    return scheduler
+
+
+def team_repos():
+    return sorted(bitbucket_client.get_team_repositories('team', 'secret'))
+
+
+def test_listings_are_paged_through(stub, scheduler):
+    stub()
+    assert team_repos() == ALL_REPOS
+    assert bitbucket_client.get_projects('team', 'secret')
+    assert scheduler.counters['retries'] == 0
+
+
+def test_throttled_requests_wait_for_retry_after(stub, scheduler):
+    server = stub(throttle_every=2, retry_after=0)
+    assert team_repos() == ALL_REPOS
+    assert server.throttled > 0
+    assert scheduler.counters['throttled'] == server.throttled
+    assert scheduler.counters['retries'] == server.throttled
+
+
+def test_failed_requests_are_retried(stub, scheduler, monkeypatch):
+    monkeypatch.setattr(bitbucket_client.time, 'sleep', lambda seconds: None)
+    server = stub(fail_rate=0.3)
+    assert team_repos() == ALL_REPOS
+    assert server.failed > 0
+    assert scheduler.counters['retries'] == server.failed
+    assert scheduler.counters['requests'] == server.request_count
+
+
+def test_gives_up_after_the_last_retry(stub, scheduler, monkeypatch):
+    monkeypatch.setattr(bitbucket_client.time, 'sleep', lambda seconds: None)
+    server = stub(fail_rate=1)
+    with pytest.raises(bitbucket_client.BitbucketError):
+        team_repos()
+    assert server.request_count == scheduler.retries + 1
+
+
+def test_retry_after():
+    class Response:
+        def __init__(self, value):
+            self.headers = {'Retry-After': value} if value else {}
+
+    assert bitbucket_client.retry_after(Response('3')) == 3.0
+    assert bitbucket_client.retry_after(Response('Wed, 21 Oct 2015 07:28:00 GMT')) == 0
+    assert bitbucket_client.retry_after(Response('soon')) is None
+    assert bitbucket_client.retry_after(Response(None)) is None
+    assert bitbucket_client.retry_after(None) is None
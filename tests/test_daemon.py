@@ -0,0 +1,86 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+import daemon
+import executor
+
+
+class Commands:
+    """Stands in for main.dispatch, recording each command the daemon runs."""
+
+    def __init__(self, status=0):
+        self.status = status
+        self.calls = []
+
+    def execute(self, command, args, refresh):
+        client = executor.client.get()
+        self.calls.append((command, args, refresh, client.cwd))
+        return self.status
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    # serve() swaps in proxies for the standard streams; put them back after
+    for name in ('stdin', 'stdout', 'stderr'):
+        monkeypatch.setattr(sys, name, getattr(sys, name))
+
+    commands = Commands(status=3)
+    server = daemon.Daemon(daemon.socket_path(), commands.execute, lambda: {'hits': 1})
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    deadline = time.time() + 5
+    while not os.path.exists(daemon.socket_path()):
+        assert time.time() < deadline, 'the daemon never started listening'
+        time.sleep(0.01)
+
+    yield commands
+
+    assert daemon.request({'shutdown': True}) == {'exit': 0}
+    thread.join(5)
+    assert not os.path.exists(daemon.socket_path())
+
+
+def test_no_daemon_runs_locally():
+    assert daemon.forward('do', {}, False) is None
+
+
+def test_command_runs_once_in_the_daemon(commands):
+    assert daemon.forward('do', {'repos': '/all'}, True) == 3
+    assert commands.calls == [('do', {'repos': '/all'}, True, os.getcwd())]
+
+    status = daemon.request({'status': True})
+    assert status['served'] == 1
+    assert status['queue_depth'] == 0
+    assert status['hits'] == 1
+
+
+def test_different_settings_run_locally(commands, monkeypatch):
+    monkeypatch.setenv('GIT_ALL_BITBUCKET_RATE', '1')
+    assert daemon.forward('do', {}, False) is None
+    assert commands.calls == []
+
+
+def test_half_sent_request_is_not_run_again(commands, monkeypatch, capsys):
+    real_send_fds = socket.send_fds
+
+    def send_part(sock, buffers, fds):
+        return real_send_fds(sock, [buffers[0][:10]], fds)
+
+    def fail(self, data):
+        raise ConnectionResetError()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(socket, 'send_fds', send_part)
+        patch.setattr(socket.socket, 'sendall', fail)
+        assert daemon.forward('do', {}, False) == 1
+    assert 'Lost connection' in capsys.readouterr().err
+
+    # The daemon drops the truncated request and keeps serving
+    assert commands.calls == []
+    assert daemon.forward('do', {}, False) == 3
+    assert len(commands.calls) == 1
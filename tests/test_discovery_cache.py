@@ -0,0 +1,117 @@
+import pytest
+
+from discovery_cache import DiscoveryCache
+
+
+class Listing:
+    """A bitbucket listing that counts how often it is fetched."""
+
+    def __init__(self, value, etag='v1'):
+        self.value = value
+        self.etag = etag
+        self.fetches = 0
+        self.checks = 0
+        self.down = False
+
+    def fetch(self, validators):
+        self.fetches += 1
+        if self.down:
+            raise IOError('bitbucket is down')
+        validators['etag'] = self.etag
+        return list(self.value)
+
+    def is_unchanged(self, validators):
+        self.checks += 1
+        if self.down:
+            raise IOError('bitbucket is down')
+        return validators.get('etag') == self.etag
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DiscoveryCache(str(tmp_path / 'discovery_cache.json'))
+
+
+def expire(cache, key):
+    cache.entries[key]['fetched'] -= cache.ttl + 1
+
+
+def test_fresh_entries_are_served_from_the_cache(cache):
+    listing = Listing(['t/a', 't/b'])
+    assert cache.lookup('team', listing.fetch, listing.is_unchanged) == ['t/a', 't/b']
+    assert cache.lookup('team', listing.fetch, listing.is_unchanged) == ['t/a', 't/b']
+    assert (listing.fetches, listing.checks) == (1, 0)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_entries_are_revalidated(cache):
+    listing = Listing(['t/a'])
+    cache.lookup('team', listing.fetch, listing.is_unchanged)
+
+    expire(cache, 'team')
+    assert cache.lookup('team', listing.fetch, listing.is_unchanged) == ['t/a']
+    assert (listing.fetches, listing.checks) == (1, 1)
+    # Revalidating starts the entry's time to live over
+    assert cache.lookup('team', listing.fetch, listing.is_unchanged) == ['t/a']
+    assert listing.checks == 1
+
+    expire(cache, 'team')
+    listing.value, listing.etag = ['t/a', 't/c'], 'v2'
+    assert cache.lookup('team', listing.fetch, listing.is_unchanged) == ['t/a', 't/c']
+    assert (listing.fetches, listing.checks) == (2, 2)
+
+
+def test_stale_entries_are_served_when_bitbucket_fails(cache):
+    listing = Listing(['t/a'])
+    cache.lookup('team', listing.fetch, listing.is_unchanged)
+
+    expire(cache, 'team')
+    listing.down = True
+    assert cache.lookup('team', listing.fetch, listing.is_unchanged) == ['t/a']
+
+    with pytest.raises(IOError):
+        cache.lookup('other', listing.fetch, listing.is_unchanged)
+
+
+def test_refresh_always_fetches(cache):
+    listing = Listing(['t/a'])
+    cache.lookup('team', listing.fetch)
+    cache.refresh = True
+    cache.lookup('team', listing.fetch)
+    assert listing.fetches == 2
+
+
+def test_streamed_listings_are_cached_once_read_to_the_end(cache):
+    pages = []
+
+    def fetch(validators):
+        pages.append(1)
+        yield 't/a'
+        yield 't/b'
+
+    items = cache.lookup('team', fetch)
+    assert next(items) == 't/a'
+    assert 'team' not in cache.entries
+    assert list(items) == ['t/b']
+    assert cache.lookup('team', fetch) == ['t/a', 't/b']
+    assert len(pages) == 1
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = DiscoveryCache(str(tmp_path / 'discovery_cache.json'), max_entries=2)
+    cache.lookup('a', Listing(['a']).fetch)
+    cache.lookup('b', Listing(['b']).fetch)
+    cache.entries['a']['used'] = 2
+    cache.entries['b']['used'] = 1
+    cache.lookup('c', Listing(['c']).fetch)
+    assert sorted(cache.entries) == ['a', 'c']
+
+
+def test_entries_survive_a_save(cache, tmp_path):
+    listing = Listing(['t/a'])
+    cache.lookup('team', listing.fetch, listing.is_unchanged)
+    cache.save()
+
+    reloaded = DiscoveryCache(str(tmp_path / 'discovery_cache.json'))
+    assert reloaded.lookup('team', listing.fetch, listing.is_unchanged) == ['t/a']
+    assert listing.fetches == 1
@@ -0,0 +1,180 @@
+import os
+import sys
+import threading
+import time
+
+import executor
+from executor import completed_map, ordered_map
+
+
+def test_prioritized_results_keep_the_order_of_items():
+    items = list(range(50))
+    results = ordered_map(lambda item: item * 2, items, jobs=4,
+                          priority=lambda item: item % 7)
+    assert list(results) == [item * 2 for item in items]
+
+    results = completed_map(lambda item: item * 2, items, jobs=4,
+                            priority=lambda item: item % 7)
+    assert sorted(results) == [item * 2 for item in items]
+
+
+def test_highest_priority_starts_first():
+    started = []
+    release = threading.Event()
+
+    def run(item):
+        if item == 'blocker':
+            release.wait(5)
+        started.append(item)
+        return item
+
+    def items():
+        yield 'blocker'
+        # Give the blocker time to take the only job, so the rest queue up
+        time.sleep(0.2)
+        yield from ['low', 'high', 'medium']
+        release.set()
+
+    priorities = {'blocker': 0, 'low': 1, 'medium': 2, 'high': 3}
+    results = list(executor.prioritized_map(run, items(), 1, priorities.get,
+                                            in_order=True))
+    assert results == ['blocker', 'low', 'high', 'medium']
+    assert started == ['blocker', 'high', 'medium', 'low']
+
+
+def test_items_are_not_pulled_far_ahead_of_a_slow_one():
+    jobs = 2
+    pulled = []
+    release = threading.Event()
+
+    def items():
+        for item in range(1000):
+            pulled.append(item)
+            yield item
+
+    def run(item):
+        if item == 0:
+            release.wait(5)
+        return item
+
+    results = []
+    consumer = threading.Thread(target=lambda: results.extend(
+        ordered_map(run, items(), jobs=jobs, priority=lambda item: 0)
+    ))
+    consumer.start()
+    time.sleep(0.5)
+    assert len(pulled) == executor.PRIORITY_LOOKAHEAD * jobs
+
+    release.set()
+    consumer.join(5)
+    assert results == list(range(1000))
+
+
+def test_stopping_early_lets_the_feeder_go():
+    pulled = []
+
+    def items():
+        for item in range(1000):
+            pulled.append(item)
+            yield item
+
+    results = ordered_map(lambda item: item, items(), jobs=2,
+                          priority=lambda item: 0)
+    assert next(results) == 0
+    results.close()
+    time.sleep(0.2)
+    count = len(pulled)
+    time.sleep(0.2)
+    assert len(pulled) == count < 1000
+
+
+PRINT_ENV = ('import os, sys; sys.stdout.write(os.environ.get("GIT_TERMINAL_PROMPT", "") '
+             '+ "|" + os.environ.get("GIT_SSH_COMMAND", ""))')
+
+
+def test_commands_without_a_terminal_run_in_batch_mode(monkeypatch):
+    monkeypatch.delenv('GIT_SSH_COMMAND', raising=False)
+    monkeypatch.delenv('GIT_SSH', raising=False)
+    out, _, status = executor.run_command([sys.executable, '-c', PRINT_ENV])
+    assert status == 0
+    assert out == '0|ssh -o BatchMode=yes'
+
+    monkeypatch.setenv('GIT_SSH_COMMAND', 'ssh -i key')
+    out, _, _ = executor.run_command([sys.executable, '-c', PRINT_ENV])
+    assert out == '0|ssh -i key'
+
+
+def test_foreground_commands_share_the_process_group():
+    print_group = [sys.executable, '-c', 'import os; print(os.getpgrp())']
+    out, _, _ = executor.run_command(print_group)
+    assert int(out) != os.getpgrp()
+
+    token = executor.foreground.set(True)
+    try:
+        out, _, _ = executor.run_command(print_group)
+        assert int(out) == os.getpgrp()
+        started = time.time()
+        _, error, status = executor.run_command(['sleep', '5'], timeout=0.2)
+        assert status is None
+        assert 'Timed out' in error
+        assert time.time() - started < 4
+    finally:
+        executor.foreground.reset(token)
+
+
+
+def test_ordered_map_keeps_the_order_of_items():
+    def run(item):
+        time.sleep((10 - item) * 0.01)
+        return item
+
+    assert list(ordered_map(run, range(10), jobs=4)) == list(range(10))
+
+
+def test_ordered_map_pulls_items_lazily():
+    jobs = 3
+    pulled = []
+    release = threading.Event()
+
+    def items():
+        for item in range(100):
+            pulled.append(item)
+            yield item
+
+    def run(item):
+        if item == 0:
+            release.wait(5)
+        return item
+
+    results = []
+    consumer = threading.Thread(target=lambda: results.extend(
+        ordered_map(run, items(), jobs=jobs)
+    ))
+    consumer.start()
+    time.sleep(0.3)
+    assert len(pulled) == 2 * jobs
+
+    release.set()
+    consumer.join(5)
+    assert results == list(range(100))
+
+
+def test_completed_map_yields_as_results_finish():
+    release = threading.Event()
+
+    def run(item):
+        if item == 0:
+            release.wait(5)
+        return item
+
+    results = completed_map(run, range(4), jobs=4)
+    first = [next(results) for _ in range(3)]
+    release.set()
+    assert sorted(first) == [1, 2, 3]
+    assert list(results) == [0]
+
+
+def test_one_job_runs_in_the_calling_thread():
+    caller = threading.get_ident()
+    threads = set(ordered_map(lambda item: threading.get_ident(), range(5), jobs=1))
+    assert threads == {caller}
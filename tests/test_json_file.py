@@ -0,0 +1,58 @@
+from json_file import JsonFile
+
+
+class Counts(JsonFile):
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.mark_changed(key)
+
+    def remove(self, key):
+        with self.lock:
+            del self.entries[key]
+            self.mark_changed(key)
+
+
+def test_save_keeps_entries_saved_by_others(tmp_path):
+    location = str(tmp_path / 'counts.json')
+    first, second = Counts(location), Counts(location)
+
+    first.set('a', 1)
+    first.set('b', 1)
+    first.save()
+    second.set('c', 2)
+    second.save()
+
+    assert Counts(location).entries == {'a': 1, 'b': 1, 'c': 2}
+
+
+def test_own_changes_win_over_the_file(tmp_path):
+    location = str(tmp_path / 'counts.json')
+    first = Counts(location)
+    first.set('a', 1)
+    first.set('b', 1)
+    first.save()
+
+    second = Counts(location)
+    first.set('a', 2)
+    first.save()
+    second.set('a', 3)
+    second.remove('b')
+    second.save()
+
+    assert Counts(location).entries == {'a': 3}
+
+
+def test_reload_picks_up_other_writes(tmp_path):
+    location = str(tmp_path / 'counts.json')
+    long_lived, other = Counts(location), Counts(location)
+    long_lived.set('mine', 1)
+
+    other.set('theirs', 2)
+    other.save()
+    long_lived.reload_if_changed()
+
+    assert long_lived.entries == {'mine': 1, 'theirs': 2}
+    assert long_lived.dirty
+    long_lived.save()
+    assert Counts(location).entries == {'mine': 1, 'theirs': 2}
@@ -0,0 +1,123 @@
+import datetime
+import subprocess
+
+import pytest
+
+from ref_state import RefState, has_moved, on_branch, parse_since
+
+NOW = datetime.datetime(2024, 5, 10, 15, 30).timestamp()
+SHA = 'a' * 40
+OTHER_SHA = 'b' * 40
+
+
+def checkout_state(branch='main', head=SHA, moved=NOW - 3600, refs=None):
+    return {'branch': branch, 'head': head, 'moved': moved, 'refs': refs or {}}
+
+
+def test_parse_since_ages():
+    assert parse_since('36h', NOW) == ('time', NOW - 36 * 3600)
+    assert parse_since('2d', NOW) == ('time', NOW - 2 * 86400)
+    assert parse_since('1w', NOW) == ('time', NOW - 7 * 86400)
+
+
+def test_parse_since_dates():
+    assert parse_since('2024-05-01', NOW) == (
+        'time', datetime.datetime(2024, 5, 1).timestamp())
+    assert parse_since('2024-05-01T09:30', NOW) == (
+        'time', datetime.datetime(2024, 5, 1, 9, 30).timestamp())
+    assert parse_since('today', NOW) == (
+        'time', datetime.datetime(2024, 5, 10).timestamp())
+    assert parse_since('yesterday', NOW) == (
+        'time', datetime.datetime(2024, 5, 9).timestamp())
+
+
+def test_parse_since_anything_else_is_a_ref():
+    assert parse_since('origin/main', NOW) == ('ref', 'origin/main')
+    assert parse_since('v1.2', NOW) == ('ref', 'v1.2')
+
+
+def test_has_moved_since_a_time():
+    assert has_moved(checkout_state(), ('time', NOW - 7200))
+    assert not has_moved(checkout_state(), ('time', NOW - 60))
+    # When it last moved can't be told, so it counts as changed
+    assert has_moved(checkout_state(moved=None), ('time', NOW))
+
+
+def test_has_moved_from_a_ref():
+    at_ref = checkout_state(refs={'origin/main': SHA})
+    assert not has_moved(at_ref, ('ref', 'origin/main'))
+    assert has_moved(checkout_state(refs={'origin/main': OTHER_SHA}),
+                     ('ref', 'origin/main'))
+    assert has_moved(checkout_state(refs={'origin/main': None}),
+                     ('ref', 'origin/main'))
+    assert not has_moved(checkout_state(), ('ref', SHA))
+    assert has_moved(checkout_state(), ('ref', OTHER_SHA))
+
+
+def test_on_branch():
+    assert on_branch(checkout_state(branch='main'), 'main')
+    assert on_branch(checkout_state(branch='release/1.2'), 'release/*')
+    assert not on_branch(checkout_state(branch='main'), 'release/*')
+    assert not on_branch(checkout_state(branch=None), '*')
+
+
+def git(cwd, *args):
+    return subprocess.run(['git', '-c', 'user.name=test', '-c',
+                           'user.email=test@example.com'] + list(args),
+                          cwd=cwd, check=True, capture_output=True,
+                          text=True).stdout.strip()
+
+
+@pytest.fixture
+def checkout(tmp_path):
+    path = tmp_path / 'repo'
+    git(tmp_path, 'init', '-q', '-b', 'main', str(path))
+    git(path, 'commit', '--allow-empty', '-q', '-m', 'first')
+    git(path, 'tag', 'v1')
+    return path
+
+
+def test_read_matches_git(checkout, conf_dir):
+    ref_state = RefState(str(conf_dir / 'ref_state.json'))
+    entry = ref_state.read(str(checkout), ['v1'])
+    assert entry['branch'] == 'main'
+    assert entry['head'] == git(checkout, 'rev-parse', 'HEAD')
+    assert entry['refs'] == {'v1': entry['head']}
+    assert not has_moved(entry, ('ref', 'v1'))
+
+
+def test_read_notices_new_commits_and_branches(checkout, conf_dir):
+    ref_state = RefState(str(conf_dir / 'ref_state.json'))
+    first = ref_state.read(str(checkout), ['v1'])
+    assert ref_state.read(str(checkout), ['v1']) is first
+
+    git(checkout, 'checkout', '-q', '-b', 'release/2')
+    git(checkout, 'commit', '--allow-empty', '-q', '-m', 'second')
+    entry = ref_state.read(str(checkout), ['v1'])
+    assert entry['branch'] == 'release/2'
+    assert entry['head'] == git(checkout, 'rev-parse', 'HEAD')
+    assert has_moved(entry, ('ref', 'v1'))
+
+
+def test_entries_survive_a_save(checkout, conf_dir):
+    location = str(conf_dir / 'ref_state.json')
+    ref_state = RefState(location)
+    entry = ref_state.read(str(checkout))
+    ref_state.save()
+
+    assert RefState(location).entries == {str(checkout): entry}
+
+
+def test_packed_annotated_tags_are_peeled(checkout, conf_dir):
+    git(checkout, 'tag', '-a', '-m', 'release', 'v2')
+    git(checkout, 'tag', '-a', '-m', 'loose', 'v3')
+    git(checkout, 'pack-refs', '--all')
+    git(checkout, 'tag', '-a', '-m', 'loose again', '-f', 'v3')
+
+    ref_state = RefState(str(conf_dir / 'ref_state.json'))
+    entry = ref_state.read(str(checkout), ['v1', 'v2', 'v3'])
+    assert entry['refs']['v2'] == entry['head']
+    assert not has_moved(entry, ('ref', 'v2'))
+    # A loose annotated tag can't be peeled without reading objects
+    assert entry['refs']['v3'] == git(checkout, 'rev-parse', 'refs/tags/v3')
+    assert has_moved(entry, ('ref', 'v3'))
@@ -0,0 +1,90 @@
+import os
+import subprocess
+
+import pytest
+
+import repo_scanner
+from repo_scanner import RepoScanner, bitbucket_full_name
+
+
+def git(*args, cwd=None):
+    subprocess.run(['git'] + list(args), cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def checkout(path, origin):
+    os.makedirs(path)
+    git('init', '-q', cwd=path)
+    if origin:
+        git('remote', 'add', 'origin', origin, cwd=path)
+    return str(path)
+
+
+@pytest.fixture
+def scanner(tmp_path):
+    return RepoScanner(str(tmp_path / 'scan_cache.json'))
+
+
+def test_bitbucket_urls_are_recognised():
+    assert bitbucket_full_name('git@bitbucket.org:team/api.git') == 'team/api'
+    assert bitbucket_full_name('ssh://git@bitbucket.org/team/api.git') == 'team/api'
+    assert bitbucket_full_name('https://me@bitbucket.org/team/api') == 'team/api'
+    assert bitbucket_full_name('https://bitbucket.org/team/api.git/') == 'team/api'
+    assert bitbucket_full_name('git@github.com:team/api.git') is None
+    assert bitbucket_full_name(None) is None
+
+
+def test_scan_finds_bitbucket_checkouts(scanner, tmp_path):
+    root = tmp_path / 'work'
+    api = checkout(root / 'api', 'git@bitbucket.org:team/api.git')
+    web = checkout(root / 'web', 'https://bitbucket.org/team/web.git')
+    checkout(root / 'elsewhere', 'git@github.com:team/elsewhere.git')
+    checkout(root / 'no-remote', None)
+    # Neither nested checkouts nor hidden directories are looked into
+    checkout(root / 'api' / 'vendor', 'git@bitbucket.org:team/vendor.git')
+    checkout(root / '.cache' / 'old', 'git@bitbucket.org:team/old.git')
+
+    assert sorted(scanner.scan(str(root))) == [('team/api', api), ('team/web', web)]
+
+
+def test_worktrees_use_the_main_checkout_config(scanner, tmp_path):
+    api = checkout(tmp_path / 'api', 'git@bitbucket.org:team/api.git')
+    git('-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-q',
+        '--allow-empty', '-m', 'first', cwd=api)
+    worktree = str(tmp_path / 'api-feature')
+    git('worktree', 'add', '-q', worktree, cwd=api)
+
+    assert scanner.origin_url(worktree) == 'git@bitbucket.org:team/api.git'
+
+
+def test_origins_are_remembered_until_the_config_changes(scanner, tmp_path, monkeypatch):
+    api = checkout(tmp_path / 'api', 'git@bitbucket.org:team/api.git')
+    reads = []
+    read_origin_url = repo_scanner.read_origin_url
+
+    def counted(config_location):
+        reads.append(config_location)
+        return read_origin_url(config_location)
+
+    monkeypatch.setattr(repo_scanner, 'read_origin_url', counted)
+    assert scanner.origin_url(api) == 'git@bitbucket.org:team/api.git'
+    assert scanner.origin_url(api) == 'git@bitbucket.org:team/api.git'
+    assert len(reads) == 1
+
+    git('remote', 'set-url', 'origin', 'git@bitbucket.org:team/api-v2.git', cwd=api)
+    assert scanner.origin_url(api) == 'git@bitbucket.org:team/api-v2.git'
+    assert len(reads) == 2
+
+    scanner.save()
+    reloaded = RepoScanner(scanner.file_location)
+    assert reloaded.origin_url(api) == 'git@bitbucket.org:team/api-v2.git'
+    assert len(reads) == 2
+
+
+def test_find_checkouts_matches_directory_and_origin(scanner, tmp_path):
+    checkout(tmp_path / 'api', 'git@bitbucket.org:team/api.git')
+    checkout(tmp_path / 'web', 'git@bitbucket.org:other/web.git')
+
+    found = scanner.find_checkouts(['team/api', 'team/web', 'team/missing'],
+                                   str(tmp_path))
+    assert found == {'team/api'}
@@ -0,0 +1,61 @@
+from repo_set import RepoSetResolver
+
+
+class FakeController:
+    def __init__(self, groups):
+        self.groups = groups
+        self.lookups = []
+
+    def list_repository_group(self, group_name):
+        self.lookups.append(group_name)
+        return self.groups.get(group_name, [])
+
+    def default_user(self):
+        return None
+
+
+def resolve(specs, **groups):
+    return RepoSetResolver(FakeController(groups)).resolve(specs)
+
+
+def test_names_keep_order_without_duplicates():
+    assert resolve('t/b,t/a,t/b') == ['t/b', 't/a']
+
+
+def test_groups_expand_in_place():
+    assert resolve('t/z,/web', web=['t/a', 't/b']) == ['t/z', 't/a', 't/b']
+
+
+def test_minus_removes_from_everything_before_it():
+    assert resolve('/all,-/web', all=['t/a', 't/b', 't/c'],
+                   web=['t/b']) == ['t/a', 't/c']
+
+
+def test_minus_does_not_remove_from_later_terms():
+    assert resolve('-t/a,t/a,t/b') == ['t/a', 't/b']
+
+
+def test_ampersand_keeps_only_the_intersection():
+    assert resolve('/all,&/web', all=['t/a', 't/b', 't/c'],
+                   web=['t/c', 't/a']) == ['t/a', 't/c']
+
+
+def test_modifiers_apply_left_to_right():
+    groups = {'all': ['t/a', 't/b', 't/c'], 'web': ['t/a', 't/b']}
+    assert resolve('/all,&/web,-t/a', **groups) == ['t/b']
+    # t/a is dropped where /all put it, but comes back later on
+    assert resolve('/all,-t/a,t/a,&/web', **groups) == ['t/b', 't/a']
+
+
+def test_each_term_is_expanded_once():
+    controller = FakeController({'web': ['t/a', 't/b']})
+    resolver = RepoSetResolver(controller)
+    assert resolver.resolve('/web,-/web,/web') == ['t/a', 't/b']
+    assert controller.lookups == ['web']
+    assert (resolver.hits, resolver.misses) == (2, 1)
+
+
+def test_unparseable_terms_are_skipped(capsys):
+    # @ terms need a user, and there is no default one
+    assert resolve('t/a,@/team') == ['t/a']
+    assert 'Cannot parse repo' in capsys.readouterr().err
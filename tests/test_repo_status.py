@@ -0,0 +1,71 @@
+import subprocess
+
+from repo_status import collect_status, format_age, is_dirty, parse_porcelain_v2
+
+PORCELAIN = '''# branch.oid 3f1e0c7b2a9d8e6f5a4b3c2d1e0f9a8b7c6d5e4f
+# branch.head main
+# branch.upstream origin/main
+# branch.ab +2 -5
+1 .M N... 100644 100644 100644 3f1e0c7 3f1e0c7 src/app.py
+1 A. N... 000000 100644 100644 0000000 9a8b7c6 src/new.py
+2 R. N... 100644 100644 100644 3f1e0c7 3f1e0c7 R100 docs/guide.md\tdocs/old.md
+u UU N... 100644 100644 100644 100644 1111111 2222222 3333333 setup.py
+? notes.txt
+? build/
+! ignored.log
+'''
+
+
+def git(*args, cwd=None):
+    return subprocess.run(
+        ['git', '-c', 'user.name=t', '-c', 'user.email=t@t'] + list(args),
+        cwd=cwd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True
+    ).stdout
+
+
+def test_porcelain_v2_is_counted():
+    assert parse_porcelain_v2(PORCELAIN) == {
+        'branch': 'main',
+        'upstream': 'origin/main',
+        'ahead': 2,
+        'behind': 5,
+        'changed': 4,
+        'untracked': 2,
+        'dirty': True
+    }
+
+
+def test_detached_clean_checkout():
+    status = parse_porcelain_v2('# branch.oid 3f1e0c7\n# branch.head (detached)\n')
+    assert status['branch'] is None
+    assert status['upstream'] is None
+    assert (status['ahead'], status['behind']) == (0, 0)
+    assert not status['dirty']
+
+
+def test_status_of_a_real_checkout(tmp_path):
+    checkout = str(tmp_path / 'api')
+    git('init', '-q', '-b', 'main', checkout)
+    git('commit', '-q', '--allow-empty', '-m', 'first', cwd=checkout)
+    assert not is_dirty(checkout)
+
+    (tmp_path / 'api' / 'notes.txt').write_text('todo\n')
+    status = collect_status(checkout)
+    assert status['branch'] == 'main'
+    assert status['untracked'] == 1
+    assert status['dirty']
+    assert status['last_commit'] == int(git('log', '-1', '--format=%ct', cwd=checkout))
+    assert is_dirty(checkout)
+
+
+def test_status_outside_a_checkout(tmp_path):
+    assert 'error' in collect_status(str(tmp_path))
+    assert is_dirty(str(tmp_path))
+
+
+def test_age_uses_the_largest_unit():
+    assert format_age(None) == '-'
+    assert format_age(1000, now=1030) == '30s'
+    assert format_age(1000, now=1000 + 3 * 3600 + 5) == '3h'
+    assert format_age(1000, now=1000 + 2 * 86400) == '2d'
@@ -0,0 +1,74 @@
+import json
+
+from results import make_writer, percentile
+
+
+def record(repo, exit_code=0, seconds=1.0, stdout='', stderr=''):
+    return {'repo': repo, 'exit_code': exit_code, 'seconds': seconds,
+            'stdout': stdout, 'stderr': stderr}
+
+
+def write_run(writer):
+    writer.write(record('t/a', seconds=1.0, stdout='a\n'))
+    writer.write(record('t/b', exit_code=2, seconds=3.0, stderr='b failed\n'))
+    writer.write(record('t/c', exit_code=None, seconds=None))
+    writer.skip({'repo': 't/d'})
+    return writer.close()
+
+
+def test_percentile_is_nearest_rank():
+    assert percentile([], 0.5) is None
+    assert percentile([3, 1, 2], 0.5) == 2
+    assert percentile(list(range(1, 101)), 0.95) == 95
+    assert percentile([5], 0.95) == 5
+
+
+def test_ndjson_prints_a_record_per_repo_and_a_summary(capsys):
+    assert write_run(make_writer('ndjson')) == 2
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(line['type'], line.get('repo')) for line in lines] == [
+        ('result', 't/a'), ('result', 't/b'), ('result', 't/c'),
+        ('skipped', 't/d'), ('summary', None)
+    ]
+    assert lines[1]['stderr'] == 'b failed\n'
+    assert lines[-1] == {
+        'type': 'summary', 'repos': 3, 'failed': 2, 'skipped': 1,
+        'seconds': {'p50': 1.0, 'p95': 3.0, 'max': 3.0}
+    }
+
+
+def test_json_is_one_document(capsys):
+    assert write_run(make_writer('json')) == 2
+
+    document = json.loads(capsys.readouterr().out)
+    assert [result['repo'] for result in document['results']] == ['t/a', 't/b', 't/c']
+    assert document['summary']['failed'] == 2
+    assert 'type' not in document['summary']
+
+
+def test_json_without_results_is_still_valid(capsys):
+    assert make_writer('json').close() == 0
+    assert json.loads(capsys.readouterr().out)['results'] == []
+
+
+def test_text_prints_output_and_failures(capsys):
+    assert write_run(make_writer('text')) == 2
+
+    captured = capsys.readouterr()
+    assert captured.out == 't/a:\na\n\nt/b:\nb failed\n\n'
+    assert '2 of 3 repos failed' in captured.err
+    assert "1 repos didn't match the filters" in captured.err
+
+
+def test_text_reports_the_failed_script_step(capsys):
+    writer = make_writer('text', streamed=True)
+    writer.write(dict(record('t/a', exit_code=1), steps=[
+        {'command': ['git', 'fetch'], 'exit_code': 0},
+        {'command': ['sh', '-c', 'make test'], 'exit_code': 1}
+    ]))
+    writer.close()
+
+    captured = capsys.readouterr()
+    assert captured.out == ''
+    assert "t/a: stopped at step 2, `sh -c 'make test'` exited 1" in captured.err
@@ -0,0 +1,89 @@
+import gc
+import json
+import sqlite3
+
+import pytest
+
+import sqlite_state
+import state
+
+
+def write_json_state(location):
+    json_state = state.State(location)
+    json_state.update_user_credentials('alice', 'YWxpY2U6cHc=')
+    json_state.update_user_credentials('bob', 'Ym9iOnB3')
+    json_state.set_default_user('bob')
+    json_state.add_to_repository_group('web', ['team/b', 'team/a'])
+    json_state.set_repo_path('team/a', '/work')
+    json_state.add_repo_location('/work', 'team/a')
+    json_state.add_repo_location('/other', 'team/a')
+    json_state.add_repo_location('/work', 'team/b')
+    json_state.commit()
+
+
+def test_migration_imports_everything(tmp_path):
+    json_location = str(tmp_path / 'credentials.conf')
+    write_json_state(json_location)
+
+    db = sqlite_state.SqliteState(str(tmp_path / 'state.db'))
+    assert db.migrate_from_json(json_location)
+
+    assert sorted(db.list_users()) == ['alice', 'bob']
+    assert db.get_user_credentials('alice') == 'YWxpY2U6cHc='
+    assert db.get_default_user() == 'bob'
+    assert db.get_repository_group('web') == ['team/b', 'team/a']
+    assert db.get_repo_path('team/a') == '/work'
+    assert db.list_repo_registrations() == [
+        ('team/a', '/other'), ('team/a', '/work'), ('team/b', '/work')
+    ]
+    assert db.get_repos_for_repo_location('/work') == ['team/a', 'team/b']
+
+
+def test_migration_only_runs_once(tmp_path, monkeypatch):
+    json_location = str(tmp_path / 'credentials.conf')
+    write_json_state(json_location)
+    db = sqlite_state.SqliteState(str(tmp_path / 'state.db'))
+    assert db.migrate_from_json(json_location)
+    db.remove_user_credentials('alice')
+
+    # Once imported, the JSON file isn't even parsed again
+    def fail(*args, **kwargs):
+        raise AssertionError('credentials.conf was parsed again')
+    monkeypatch.setattr(json, 'load', fail)
+    assert not db.migrate_from_json(json_location)
+    assert db.list_users() == ['bob']
+
+
+def test_get_state_migrates_an_existing_json_state():
+    write_json_state(state.conf_path('credentials.conf'))
+
+    db = state.get_state()
+    try:
+        assert isinstance(db, sqlite_state.SqliteState)
+        assert db.get_default_user() == 'bob'
+    finally:
+        db.close()
+
+
+def test_json_backend_can_still_be_chosen(monkeypatch):
+    write_json_state(state.conf_path('credentials.conf'))
+    monkeypatch.setenv('GIT_ALL_STATE_BACKEND', 'json')
+
+    assert isinstance(state.get_state(), state.State)
+
+
+def test_missing_conf_dir_is_created(tmp_path, monkeypatch):
+    conf_dir = tmp_path / 'new' / 'conf'
+    monkeypatch.setenv('GIT_ALL_CONF_DIR', str(conf_dir))
+
+    db = state.get_state()
+    db.update_user_credentials('alice', 'YWxpY2U6cHc=')
+    db.close()
+    assert (conf_dir / 'state.db').exists()
+
+
+@pytest.mark.filterwarnings('error::pytest.PytestUnraisableExceptionWarning')
+def test_unopenable_database_is_cleaned_up(tmp_path):
+    with pytest.raises(sqlite3.OperationalError):
+        sqlite_state.SqliteState(str(tmp_path / 'missing' / 'state.db'))
+    gc.collect()
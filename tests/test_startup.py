@@ -0,0 +1,10 @@
+import benchmark
+
+
+def test_local_commands_start_fast_without_the_network_stack():
+    """The same check `benchmark.py` ends with, so a regression in startup
+    time or an eager `import requests` fails the test run too."""
+    startup = benchmark.measure_startup(runs=5)
+    assert [command['command'] for command in startup['commands']] == \
+        benchmark.LOCAL_COMMANDS
+    assert benchmark.check_startup(startup, benchmark.DEFAULT_STARTUP_BUDGET) == []
@@ -0,0 +1,96 @@
+import subprocess
+
+import pytest
+
+from sync import sync_checkout
+
+
+def git(cwd, *args):
+    return subprocess.run(['git'] + list(args), cwd=cwd, check=True,
+                          capture_output=True, text=True).stdout.strip()
+
+
+def commit(cwd, message):
+    git(cwd, 'commit', '--allow-empty', '-q', '-m', message)
+    git(cwd, 'push', '-q', 'origin', 'main')
+
+
+@pytest.fixture
+def repos(tmp_path, monkeypatch):
+    """An origin, a clone to push new commits from, and the checkout that
+    gets synced."""
+    for name, value in (('GIT_AUTHOR_NAME', 'test'), ('GIT_COMMITTER_NAME', 'test'),
+                        ('GIT_AUTHOR_EMAIL', 'test@example.com'),
+                        ('GIT_COMMITTER_EMAIL', 'test@example.com')):
+        monkeypatch.setenv(name, value)
+    origin = tmp_path / 'origin.git'
+    git(tmp_path, 'init', '-q', '--bare', '-b', 'main', str(origin))
+    upstream = tmp_path / 'upstream'
+    git(tmp_path, 'clone', '-q', str(origin), str(upstream))
+    git(upstream, 'checkout', '-q', '-b', 'main')
+    commit(upstream, 'first')
+    checkout = tmp_path / 'checkout'
+    git(tmp_path, 'clone', '-q', str(origin), str(checkout))
+    return upstream, checkout
+
+
+def head(checkout):
+    return git(checkout, 'rev-parse', 'HEAD')
+
+
+def test_nothing_to_do_when_the_remote_has_not_moved(repos):
+    upstream, checkout = repos
+    first = sync_checkout(str(checkout), None)
+    assert first['status'] == 'unchanged'
+    assert sync_checkout(str(checkout), first['refs'])['status'] == 'unchanged'
+
+
+def test_a_moved_remote_is_fetched_and_fast_forwarded(repos):
+    upstream, checkout = repos
+    last_seen = sync_checkout(str(checkout), None)['refs']
+    commit(upstream, 'second')
+
+    result = sync_checkout(str(checkout), last_seen)
+    assert result['status'] == 'updated'
+    assert head(checkout) == head(upstream)
+    assert result['refs'] != last_seen
+
+
+def test_fetch_only_leaves_the_branch_behind(repos):
+    upstream, checkout = repos
+    last_seen = sync_checkout(str(checkout), None)['refs']
+    before = head(checkout)
+    commit(upstream, 'second')
+
+    result = sync_checkout(str(checkout), last_seen, fast_forward=False)
+    assert result['status'] == 'fetched'
+    assert head(checkout) == before
+
+
+def test_a_branch_left_behind_by_a_fetch_is_caught_up(repos):
+    upstream, checkout = repos
+    last_seen = sync_checkout(str(checkout), None)['refs']
+    commit(upstream, 'second')
+    last_seen = sync_checkout(str(checkout), last_seen, fast_forward=False)['refs']
+
+    # The remote hasn't moved since, but the checkout is still behind it
+    assert sync_checkout(str(checkout), last_seen)['status'] == 'updated'
+    assert head(checkout) == head(upstream)
+    assert sync_checkout(str(checkout), last_seen)['status'] == 'unchanged'
+
+
+def test_local_commits_are_left_alone(repos):
+    upstream, checkout = repos
+    last_seen = sync_checkout(str(checkout), None)['refs']
+    git(checkout, 'commit', '--allow-empty', '-q', '-m', 'local')
+    local = head(checkout)
+
+    assert sync_checkout(str(checkout), last_seen)['status'] == 'unchanged'
+    assert head(checkout) == local
+
+
+def test_an_unreachable_remote_fails(repos, tmp_path):
+    upstream, checkout = repos
+    git(checkout, 'remote', 'set-url', 'origin', str(tmp_path / 'missing.git'))
+
+    assert sync_checkout(str(checkout), None)['status'] == 'failed'
@@ -0,0 +1,103 @@
+import json
+import sys
+
+from workers import (LocalTransport, SshTransport, make_transport, partition,
+                     run_sharded)
+
+# Stands in for `git-all do --format ndjson` on a worker: prints a record for
+# each repo it was given, or dies without reporting any
+WORKER = '''
+import json, sys
+installed, fail, repos = json.loads(sys.argv[1]), sys.argv[2] == "1", sys.argv[3:]
+if fail:
+    sys.stderr.write("worker is down\\n")
+    sys.exit(255)
+for repo in repos:
+    if repo in installed:
+        record = {"type": "result", "repo": repo, "exit_code": 0, "seconds": 0.1}
+    else:
+        record = {"type": "result", "repo": repo, "exit_code": None,
+                  "error": "not installed"}
+    print(json.dumps(record), flush=True)
+'''
+
+
+class FakeTransport:
+    def __init__(self, name, installed=(), fail=False):
+        self.name = name
+        self.installed = list(installed)
+        self.fail = fail
+        self.shards = []
+
+    def command(self, argv):
+        self.shards.append(argv)
+        return [sys.executable, '-c', WORKER, json.dumps(self.installed),
+                '1' if self.fail else '0'] + argv
+
+    def env(self):
+        return None
+
+
+def run(transports, repos):
+    records = list(run_sharded(transports, repos, lambda shard_repos: shard_repos))
+    return {record['repo']: record for record in records}, records
+
+
+def test_repos_are_dealt_out_round_robin():
+    assert partition(['a', 'b', 'c', 'd', 'e'], 2) == [['a', 'c', 'e'], ['b', 'd']]
+    assert partition(['a'], 3) == [['a'], [], []]
+
+
+def test_each_repo_runs_once_on_its_worker():
+    repos = ['t/a', 't/b', 't/c', 't/d']
+    first = FakeTransport('one', installed=repos)
+    second = FakeTransport('two', installed=repos)
+
+    by_repo, records = run([first, second], repos)
+    assert len(records) == 4
+    assert {repo: record['worker'] for repo, record in by_repo.items()} == {
+        't/a': 'one', 't/b': 'two', 't/c': 'one', 't/d': 'two'
+    }
+    assert all(record['exit_code'] == 0 for record in records)
+
+
+def test_a_failed_worker_s_repos_are_retried_elsewhere(capsys):
+    repos = ['t/a', 't/b', 't/c']
+    down = FakeTransport('down', installed=repos, fail=True)
+    up = FakeTransport('up', installed=repos)
+
+    by_repo, records = run([down, up], repos)
+    assert len(records) == 3
+    assert all(record['worker'] == 'up' for record in records)
+    assert all(record['exit_code'] == 0 for record in records)
+    assert up.shards == [['t/b'], ['t/a', 't/c']]
+    assert 'Worker down failed with 2 repo(s) unreported' in capsys.readouterr().err
+
+
+def test_repos_not_installed_on_one_worker_are_retried_on_another():
+    first = FakeTransport('one', installed=['t/a'])
+    second = FakeTransport('two', installed=['t/a', 't/c'])
+
+    by_repo, records = run([first, second], ['t/a', 't/b', 't/c'])
+    assert len(records) == 3
+    assert by_repo['t/a']['worker'] == 'one'
+    assert by_repo['t/c']['worker'] == 'two'
+    assert by_repo['t/c']['exit_code'] == 0
+    # Nobody has it: the last worker's answer stands
+    assert by_repo['t/b']['error'] == 'not installed'
+
+
+def test_repos_no_worker_could_run_are_reported():
+    down = FakeTransport('down', fail=True)
+    also_down = FakeTransport('also-down', fail=True)
+
+    by_repo, records = run([down, also_down], ['t/a', 't/b'])
+    assert sorted(by_repo) == ['t/a', 't/b']
+    assert all(record['error'] == 'no worker could run it' for record in records)
+
+
+def test_make_transport():
+    assert isinstance(make_transport('local'), LocalTransport)
+    assert make_transport('local:/tmp/conf').conf_dir == '/tmp/conf'
+    assert make_transport('ssh:build1').host == 'build1'
+    assert isinstance(make_transport('build2'), SshTransport)